@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import Queue
+import atexit
+import logging
+import threading
+from datetime import datetime
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from oauthsp.models import AuditEvent
+from oauthsp.utils import RotatingFileWriter, Stats
+
+# Token lifecycle events (issue, authorize, exchange, renew and
+# revoke) are put in a bounded queue and written in batches by
+# a background thread, so the views don't wait for them.
+# OAUTH_AUDIT_LOG is either 'db', for the AuditEvent table, or
+# the path of a rotating log file. It's disabled by default.
+# When the queue is full, record() waits up to
+# OAUTH_AUDIT_BLOCK_TIMEOUT seconds and then drops the event.
+
+AUDIT_LOG = getattr(settings, 'OAUTH_AUDIT_LOG', None)
+AUDIT_QUEUE_SIZE = getattr(settings, 'OAUTH_AUDIT_QUEUE_SIZE', 10000)
+AUDIT_BATCH_SIZE = getattr(settings, 'OAUTH_AUDIT_BATCH_SIZE', 500)
+AUDIT_BLOCK_TIMEOUT = getattr(settings, 'OAUTH_AUDIT_BLOCK_TIMEOUT', 0)
+AUDIT_LOG_MAX_BYTES = getattr(settings, 'OAUTH_AUDIT_LOG_MAX_BYTES', 10 * 1024 * 1024)
+AUDIT_LOG_BACKUPS = getattr(settings, 'OAUTH_AUDIT_LOG_BACKUPS', 5)
+
+def write_table(events):
+    qn = connection.ops.quote_name
+    fields = [f for f in AuditEvent._meta.local_fields if not f.primary_key]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(AuditEvent._meta.db_table),
+        ', '.join([qn(f.column) for f in fields]), ', '.join(['%s'] * len(fields)))
+    connection.cursor().executemany(sql, events)
+    transaction.commit_unless_managed()
+
+def file_writer(path):
+    writer = RotatingFileWriter(path, AUDIT_LOG_MAX_BYTES, AUDIT_LOG_BACKUPS)
+    def write_file(events):
+        writer.write(['%s\n' % '\t'.join([v is not None and unicode(v) or u'-' \
+            for v in event]).encode('utf-8') for event in events])
+    return write_file
+
+class AuditLog(object):
+    def __init__(self, writer, size, batch_size, block_timeout):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.block_timeout = block_timeout
+        self.queue = Queue.Queue(size)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()
+        self.stats = Stats()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.work, name='oauthsp-audit')
+                self.thread.setDaemon(True)
+                self.thread.start()
+        finally:
+            self.lock.release()
+
+    def record(self, event, token, request=None):
+        if self.writer is None:
+            return
+
+        remote_addr = request and request.META.get('REMOTE_ADDR', '') or ''
+        entry = (event, datetime.now(), token.consumer_id, token.key,
+            token.user_id, remote_addr)
+        self.start()
+        try:
+            self.queue.put_nowait(entry)
+            return
+        except Queue.Full:
+            pass
+
+        try:
+            if not self.block_timeout:
+                raise Queue.Full
+            self.stats.add('blocked', 1)
+            self.queue.put(entry, True, self.block_timeout)
+        except Queue.Full:
+            self.stats.add('dropped', 1)
+
+    def take(self, block):
+        batch = []
+        try:
+            if block:
+                batch.append(self.queue.get())
+            while len(batch) < self.batch_size:
+                batch.append(self.queue.get_nowait())
+        except Queue.Empty:
+            pass
+        return batch
+
+    def write(self, batch):
+        self.write_lock.acquire()
+        try:
+            try:
+                self.writer(batch)
+                self.stats.add('written', len(batch))
+            except Exception:
+                logging.exception('Error writing %d audit events' % len(batch))
+                self.stats.add('failed', len(batch))
+        finally:
+            self.write_lock.release()
+
+    def work(self):
+        while True:
+            batch = self.take(True)
+            try:
+                self.write(batch)
+            finally:
+                # Every thread gets its own connection
+                connection.close()
+
+    def flush(self):
+        """Writes the queued events from the calling thread"""
+        while True:
+            batch = self.take(False)
+            if not batch:
+                break
+            self.write(batch)
+
+    def get_stats(self):
+        stats = {'queued': self.queue.qsize()}
+        for name in ('written', 'failed', 'blocked', 'dropped'):
+            stats[name] = self.stats.get(name, (0,))[0]
+        return stats
+
+if AUDIT_LOG == 'db':
+    writer = write_table
+elif AUDIT_LOG:
+    writer = file_writer(AUDIT_LOG)
+else:
+    writer = None
+
+audit_log = AuditLog(writer, AUDIT_QUEUE_SIZE, AUDIT_BATCH_SIZE, AUDIT_BLOCK_TIMEOUT)
+atexit.register(audit_log.flush)
+
+def get_stats():
+    return audit_log.get_stats()
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sys
+import time
+import random
+
+from oauthsp.paginator import Paginator
+from oauthsp.schema import parse_attributes, format_attributes
+
+# Micro benchmarks for the hot paths in oauthsp. Run them
+# with ./manage.py oauthsp_benchmark [name ...]
+
+BENCHMARKS = []
+
+def benchmark(func):
+    BENCHMARKS.append(func)
+    return func
+
+def measure(label, func, repeat=1000, out=sys.stdout):
+    start = time.time()
+    for i in xrange(repeat):
+        func()
+    elapsed = time.time() - start
+    out.write('%-50s %10.1f us/call %10.0f calls/s\n' % \
+        (label, elapsed * 1000000 / repeat, repeat / elapsed))
+    return elapsed
+
+def run(names=None, out=sys.stdout):
+    for func in BENCHMARKS:
+        if not names or func.__name__ in names:
+            out.write('%s\n' % func.__name__)
+            func(out)
+
+@benchmark
+def page_list(out):
+    per_page = 10
+    objects = xrange(10000 * per_page)
+    for number in (1, 5000, 10000):
+        paginator = Paginator(objects, per_page, base_url='/consumers/',
+            page_suffix='%d/', current=number)
+        measure('10k pages, rendering page %d' % number,
+            paginator.page_list.as_ul, out=out)
+
+    paginator = Paginator(objects, per_page, base_url='/consumers/',
+        page_suffix='%d/', current=5000, page_list_cache_timeout=60)
+    measure('10k pages, rendering page 5000 (cached)',
+        paginator.page_list.as_ul, out=out)
+
+@benchmark
+def attributes(out):
+    items = [(u'attr%d' % i, u'value %d' % i) for i in range(8)]
+    items.append((u'escaped', u'a;b:c\\d'))
+    s = format_attributes(items)
+    measure('parse %d attributes' % len(items),
+        lambda: parse_attributes(s), repeat=10000, out=out)
+    measure('format %d attributes' % len(items),
+        lambda: format_attributes(items), repeat=10000, out=out)
+
+@benchmark
+def request_token(out):
+    from django.contrib.auth.models import User
+    from oauthsp.models import Consumer, Token, random_string
+    # Writes to the configured database, the rows are removed
+    # afterwards
+    user = User.objects.create_user('benchmark-%s' % random_string(8),
+        'benchmark@example.com')
+    consumer = Consumer(user=user, name=u'Benchmark %s' % user.username,
+        version=u'1.0', consumer_type='D', developer_email=u'dev@example.com',
+        uri=u'http://example.com', description=u'Benchmark')
+    consumer.save()
+    attributes = format_attributes([(u'attr%d' % i, u'%d' % i) for i in range(4)])
+
+    def separate_writes():
+        token = Token(consumer=consumer)
+        token.save()
+        token.attrs.set_attributes(attributes)
+
+    try:
+        measure('request token, separate writes', separate_writes,
+            repeat=200, out=out)
+        measure('request token, single transaction',
+            lambda: Token.create_request_token(consumer, None, attributes),
+            repeat=200, out=out)
+    finally:
+        consumer.delete()
+        user.delete()
+
+def explain(queryset, out):
+    from django.conf import settings
+    from django.db import connection
+    sql, params = queryset.query.as_sql()
+    prefix = settings.DATABASE_ENGINE == 'sqlite3' and 'EXPLAIN QUERY PLAN' or 'EXPLAIN'
+    cursor = connection.cursor()
+    cursor.execute('%s %s' % (prefix, sql), params)
+    for row in cursor.fetchall():
+        out.write('    %s\n' % ' '.join([unicode(v) for v in row]))
+
+@benchmark
+def scaling(out):
+    """Latency and query plans of the hot queries on the current
+    data. Load data of increasing size with oauthsp_generate
+    (--scale) and run it after each step to compare."""
+    from oauthsp.dataset import max_id
+    from oauthsp.models import Consumer, Token, Nonce, random_string
+    for model in (Consumer, Token, Nonce):
+        out.write('%-50s %10d\n' % ('%s, max id' % model._meta.db_table, max_id(model)))
+
+    top = max_id(Token)
+    tokens = list(Token.access.filter(id__gte=random.randint(1, max(top, 1)))[:100]) or \
+        list(Token.access.all()[:100])
+    if not tokens:
+        out.write('No access tokens, load some data with oauthsp_generate first\n')
+        return
+
+    def token_lookup():
+        token = random.choice(tokens)
+        return Token.objects.get(consumer=token.consumer_id, key=token.key, revoked=False)
+    def nonce_insert():
+        token = random.choice(tokens)
+        Nonce(consumer_id=token.consumer_id, token_id=token.id, value=random_string(16)).save()
+    def revoke_page():
+        return list(Token.access.filter(user=random.choice(tokens).user_id))
+
+    cset = Consumer.objects.exclude(private=True)
+    queries = (
+        ('validate_access token lookup', token_lookup,
+            Token.objects.filter(consumer=tokens[0].consumer_id, key=tokens[0].key, revoked=False)),
+        ('nonce insert', nonce_insert, None),
+        ('revoke page tokens', revoke_page, Token.access.filter(user=tokens[0].user_id)),
+        ('directory, first page by score', lambda: list(cset.order_by('-score', '-id')[:10]),
+            cset.order_by('-score', '-id')[:10]),
+        ('directory, keyset page by date', lambda: list(cset.filter(
+            updated_date__lt=tokens[0].creation_date).order_by('-updated_date', '-id')[:10]),
+            cset.filter(updated_date__lt=tokens[0].creation_date).order_by('-updated_date', '-id')[:10]),
+    )
+    for label, func, queryset in queries:
+        measure(label, func, repeat=200, out=out)
+        if queryset is not None:
+            explain(queryset, out)
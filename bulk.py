@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import csv
+import itertools
+from datetime import datetime, timedelta
+
+from django.db import models, connection, transaction
+from django.core.management.color import no_style
+from django.utils import simplejson
+
+from oauthsp.models import Consumer, Token, EmptyAttributes, \
+    get_token_attrs_model, random_string
+from oauthsp.search import index_unindexed
+from oauthsp.negcache import consumer_misses, token_misses
+
+# Streaming import and export of consumers, tokens and token
+# attributes as JSON lines or CSV. Rows are read in id ordered
+# chunks and written with one executemany() per chunk, so memory
+# use doesn't depend on the table size. Keys and secrets are
+# kept as they are, as are the ids, so foreign keys survive.
+
+CHUNK_SIZE = 1000
+FORMATS = ('jsonl', 'csv')
+
+def get_model(kind):
+    if kind == 'consumers':
+        return Consumer
+    if kind == 'tokens':
+        return Token
+    if kind == 'attributes':
+        model = get_token_attrs_model()
+        if model is EmptyAttributes:
+            raise ValueError('OAUTH_TOKEN_ATTRS_MODEL is not set')
+        return model
+    raise ValueError('Unknown kind "%s"' % kind)
+
+def encode_value(field, value):
+    if value is None:
+        return None
+    if isinstance(field, models.BooleanField):
+        return bool(value)
+    if isinstance(field, (models.DateTimeField, models.DateField)):
+        return unicode(value)
+    return value
+
+def decode_value(field, value):
+    if value is None or (value == '' and field.null):
+        return None
+    if isinstance(field, models.BooleanField) and isinstance(value, basestring):
+        return value.lower() in ('1', 't', 'true')
+    return field.to_python(value)
+
+def iter_rows(model, chunk_size=CHUNK_SIZE):
+    """Yields every row in model as a list of values, ordered
+    by id, fetching chunk_size rows at a time."""
+    qn = connection.ops.quote_name
+    fields = model._meta.local_fields
+    pk = qn(model._meta.pk.column)
+    sql = 'SELECT %s FROM %s WHERE %s > %%s ORDER BY %s LIMIT %d' % \
+        (', '.join([qn(f.column) for f in fields]), qn(model._meta.db_table),
+        pk, pk, chunk_size)
+    pk_index = fields.index(model._meta.pk)
+    last = 0
+    cursor = connection.cursor()
+    while True:
+        cursor.execute(sql, [last])
+        rows = cursor.fetchall()
+        if not rows:
+            break
+        for row in rows:
+            yield [encode_value(f, v) for f, v in zip(fields, row)]
+        last = rows[-1][pk_index]
+
+def export_rows(model, fobj, format, progress=None):
+    """Writes every row in model to fobj. Returns the number of rows."""
+    names = [f.attname for f in model._meta.local_fields]
+    if format == 'csv':
+        writer = csv.writer(fobj)
+        writer.writerow(names)
+        write = lambda row: writer.writerow([v is not None and \
+            unicode(v).encode('utf-8') or '' for v in row])
+    else:
+        write = lambda row: fobj.write('%s\n' % simplejson.dumps(dict(zip(names, row))))
+
+    count = 0
+    for row in iter_rows(model):
+        write(row)
+        count += 1
+        if progress and not count % CHUNK_SIZE:
+            progress(count)
+    return count
+
+def read_rows(fobj, format):
+    """Yields a dict for every row in fobj."""
+    if format == 'csv':
+        reader = csv.reader(fobj)
+        names = reader.next()
+        for row in reader:
+            yield dict(zip(names, [v.decode('utf-8') for v in row]))
+    else:
+        for line in fobj:
+            line = line.strip()
+            if line:
+                yield simplejson.loads(line)
+
+def prepare_consumer(values):
+    # Same as Consumer.save(), but imported dates are kept
+    if not values['key']:
+        values['key'] = random_string(32)
+        values['secret'] = random_string(32)
+    if values['updated_date'] is None:
+        values['updated_date'] = datetime.now()
+
+def prepare_token(values):
+    # Same as Token.save()
+    if not values['key']:
+        values['key'] = random_string(32)
+        values['secret'] = random_string(32)
+        values['session_handle'] = random_string(32)
+    values['expiration_date'] = values['creation_date'] + \
+        timedelta(seconds=int(values['duration']))
+
+def insert_values(model, values, chunk_size=CHUNK_SIZE, progress=None, with_ids=True):
+    """Inserts values, an iterable of lists with a database ready
+    value for every field in model._meta.local_fields, chunk_size
+    rows per executemany(). When with_ids is False the lists don't
+    include the primary key and the database assigns it. Returns
+    the number of rows inserted."""
+    qn = connection.ops.quote_name
+    fields = [f for f in model._meta.local_fields if with_ids or f is not model._meta.pk]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (qn(model._meta.db_table),
+        ', '.join([qn(f.column) for f in fields]), ', '.join(['%s'] * len(fields)))
+    cursor = connection.cursor()
+    batch = []
+    count = 0
+    for row in values:
+        batch.append(row)
+        if len(batch) >= chunk_size:
+            cursor.executemany(sql, batch)
+            transaction.commit_unless_managed()
+            count += len(batch)
+            batch = []
+            if progress:
+                progress(count)
+
+    if batch:
+        cursor.executemany(sql, batch)
+        count += len(batch)
+
+    if with_ids:
+        # Ids were inserted explicitly, move the sequences past them
+        for statement in connection.ops.sequence_reset_sql(no_style(), [model]):
+            cursor.execute(statement)
+    transaction.commit_unless_managed()
+    return count
+
+def discard_misses(model):
+    """Forgets the cached misses for the keys which exist now.
+    Only the misses are looked up, so it doesn't depend on the
+    number of rows imported."""
+    if model is Consumer:
+        misses = consumer_misses
+        def found(keys):
+            return Consumer.objects.filter(key__in=keys).values_list('key', flat=True)
+    elif model is Token:
+        misses = token_misses
+        def found(keys):
+            return Token.objects.filter(key__in=[key for consumer_id, key in keys]) \
+                .values_list('consumer', 'key')
+    else:
+        return
+
+    keys = misses.keys()
+    # Below the limit of bound parameters in SQLite
+    for i in xrange(0, len(keys), 500):
+        for key in found(keys[i:i + 500]):
+            misses.discard(key)
+
+def import_rows(model, rows, chunk_size=CHUNK_SIZE, progress=None):
+    """Inserts the rows (dicts keyed by field attname) into model.
+    Fields missing in a row take their default value. Ids are kept
+    when the first row has one, otherwise the database assigns
+    them to every row. Returns the number of rows inserted."""
+    rows = iter(rows)
+    try:
+        first = rows.next()
+    except StopIteration:
+        return 0
+    pk = model._meta.pk
+    with_ids = first.get(pk.attname) not in (None, '')
+    fields = [f for f in model._meta.local_fields if with_ids or f is not pk]
+    def prepare(row):
+        values = {}
+        for field in fields:
+            if field.attname in row:
+                values[field.attname] = decode_value(field, row[field.attname])
+            else:
+                values[field.attname] = field.get_default()
+        if model is Consumer:
+            prepare_consumer(values)
+        elif model is Token:
+            prepare_token(values)
+        for field in fields:
+            # The tables have no defaults, the INSERT would fail
+            if values[field.attname] is None and not field.null:
+                raise ValueError('No value for %s.%s' % (model.__name__, field.attname))
+        return [f.get_db_prep_save(values[f.attname]) for f in fields]
+
+    count = insert_values(model, itertools.imap(prepare, itertools.chain([first], rows)),
+        chunk_size, progress, with_ids)
+    if model is Consumer:
+        # No post_save was sent, so name_taken() and search()
+        # wouldn't find them
+        index_unindexed()
+    discard_misses(model)
+    return count
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re
+import time
+import atexit
+import itertools
+import threading
+
+from django.conf import settings
+from django.http import HttpRequest, QueryDict
+from django.utils import simplejson
+from django.utils.datastructures import MergeDict
+
+from oauthsp.exceptions import OAuthError
+from oauthsp.signatures import get_signature_method
+from oauthsp.utils import RotatingFileWriter, quote
+
+# Opt-in capture of the inputs OAuthRequest works on (method,
+# URI, query string, form body and Authorization header), so
+# real traffic can be replayed with the oauthsp_replay command.
+# Signatures and any parameter named like a secret or a password
+# are redacted; replay signs the requests again with the secrets
+# in the local database. Set OAUTH_CAPTURE_LOG to the path of
+# the (rotating) log and OAUTH_CAPTURE_SAMPLE to capture only
+# 1 in N requests. Records are buffered and appended in batches.
+
+CAPTURE_LOG = getattr(settings, 'OAUTH_CAPTURE_LOG', None)
+CAPTURE_SAMPLE = getattr(settings, 'OAUTH_CAPTURE_SAMPLE', 1)
+CAPTURE_BUFFER = getattr(settings, 'OAUTH_CAPTURE_BUFFER', 100)
+CAPTURE_LOG_MAX_BYTES = getattr(settings, 'OAUTH_CAPTURE_LOG_MAX_BYTES', 50 * 1024 * 1024)
+CAPTURE_LOG_BACKUPS = getattr(settings, 'OAUTH_CAPTURE_LOG_BACKUPS', 5)
+
+FORM_CONTENT_TYPE = 'application/x-www-form-urlencoded'
+REDACTED = '-'
+
+REDACT_PARAM_RE = re.compile(r'((?:^|[&;])(?:oauth_signature|[^&;=]*(?:secret|password)[^&;=]*)=)[^&;]*', re.I)
+# Header values may be quoted or not
+REDACT_HEADER_RE = re.compile(r'(oauth_signature=)("?)[^",]*')
+
+def redact_params(qs):
+    return REDACT_PARAM_RE.sub(r'\g<1>%s' % REDACTED, qs)
+
+def redact_header(header):
+    return REDACT_HEADER_RE.sub(r'\g<1>\g<2>%s' % REDACTED, header)
+
+def request_record(request):
+    """Returns the compact, redacted record for request"""
+    meta = request.META
+    record = {
+        'm': request.method,
+        's': request.is_secure() and 1 or 0,
+        'h': request.get_host(),
+        'p': request.path,
+        'q': redact_params(meta.get('QUERY_STRING', '')),
+    }
+    if 'HTTP_AUTHORIZATION' in meta:
+        record['a'] = redact_header(meta['HTTP_AUTHORIZATION'])
+    if request.method == 'POST' and meta.get('CONTENT_TYPE') == FORM_CONTENT_TYPE:
+        record['b'] = redact_params(request.raw_post_data)
+    return record
+
+class CaptureLog(object):
+    def __init__(self, writer, sample, buffer_size):
+        self.writer = writer
+        self.sample = sample
+        self.buffer_size = buffer_size
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.buffer = []
+
+    def capture(self, request):
+        if self.writer is None or self.counter.next() % self.sample:
+            return
+
+        line = '%s\n' % simplejson.dumps(request_record(request), separators=(',', ':'))
+        self.lock.acquire()
+        try:
+            self.buffer.append(line)
+            if len(self.buffer) >= self.buffer_size:
+                self._write()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self._write()
+        finally:
+            self.lock.release()
+
+    def _write(self):
+        if self.buffer:
+            lines, self.buffer = self.buffer, []
+            self.writer.write(lines)
+
+if CAPTURE_LOG:
+    writer = RotatingFileWriter(CAPTURE_LOG, CAPTURE_LOG_MAX_BYTES, CAPTURE_LOG_BACKUPS)
+else:
+    writer = None
+
+capture_log = CaptureLog(writer, CAPTURE_SAMPLE, CAPTURE_BUFFER)
+atexit.register(capture_log.flush)
+
+# Replay
+
+class ReplayRequest(HttpRequest):
+    """HttpRequest rebuilt from a captured record"""
+    def __init__(self, record):
+        HttpRequest.__init__(self)
+        self.method = str(record['m'])
+        self.path = record['p']
+        self.secure = bool(record['s'])
+        query_string = record['q'].encode('utf-8')
+        self.META = {'QUERY_STRING': query_string, 'HTTP_HOST': record['h'].encode('utf-8')}
+        self.GET = QueryDict(query_string)
+        self.POST = QueryDict('')
+        self.raw_post_data = ''
+        if 'b' in record:
+            self.raw_post_data = record['b'].encode('utf-8')
+            self.META['CONTENT_TYPE'] = FORM_CONTENT_TYPE
+            self.POST = QueryDict(self.raw_post_data)
+        if 'a' in record:
+            self.META['HTTP_AUTHORIZATION'] = record['a'].encode('utf-8')
+        self.REQUEST = MergeDict(self.POST, self.GET)
+
+    def is_secure(self):
+        return self.secure
+
+def set_param(qs, name, value):
+    return re.sub(r'((?:^|[&;])%s=)[^&;]*' % name, lambda m: m.group(1) + value, qs)
+
+def set_header_param(header, name, value):
+    return re.sub(r'(%s=)("?)[^",]*' % name, lambda m: m.group(1) + m.group(2) + value, header)
+
+def resign(record):
+    """Returns a copy of the captured record with a fresh
+    timestamp and nonce, signed with the secrets of the consumer
+    and token in the local database"""
+    from oauthsp.models import random_string
+    from oauthsp.request import OAuthRequest
+
+    record = dict(record)
+    params = (('oauth_timestamp', str(int(time.time()))), ('oauth_nonce', random_string(16)))
+    for name, value in params:
+        for field in ('q', 'b'):
+            if field in record:
+                record[field] = set_param(record[field], name, value)
+        if 'a' in record:
+            record['a'] = set_header_param(record['a'], name, value)
+
+    request = OAuthRequest(ReplayRequest(record))
+    request.validate_consumer()
+    request.validate_token()
+    method = get_signature_method(request.OAUTH.get('signature_method'))
+    signature = quote(method.signature(request))
+    for field in ('q', 'b'):
+        if field in record:
+            record[field] = set_param(record[field], 'oauth_signature', signature)
+    if 'a' in record:
+        record['a'] = set_header_param(record['a'], 'oauth_signature', signature)
+    return record
+
+def replay_record(line):
+    """Signs a captured request again and runs it through
+    OAuthRequest.validate(). Returns the seconds taken and the
+    outcome, 'ok' or the name of the OAuthError raised."""
+    from oauthsp.request import OAuthRequest
+
+    try:
+        record = resign(simplejson.loads(line))
+    except OAuthError, e:
+        return 0.0, 'unsigned %s' % e.__class__.__name__
+
+    request = OAuthRequest(ReplayRequest(record))
+    start = time.time()
+    try:
+        request.validate()
+        outcome = 'ok'
+    except OAuthError, e:
+        outcome = e.__class__.__name__
+    return time.time() - start, outcome
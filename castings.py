@@ -37,7 +37,11 @@ def get_field_cast(field):
     if isinstance(field, models.CharField):
         return get_char_cast(field.max_length)
 
-    raise RunTimeError('"%s" fields are not supported as token attributes' % field.__class__)
+    raise RuntimeError('"%s" fields are not supported as token attributes' % field.__class__)
+
+def get_field_serializer(field):
+    # Every supported type round trips through its casting
+    return unicode
 
 def integer_cast(value):
     return int(value)
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import random
+import hashlib
+from datetime import datetime, timedelta
+
+from django.db import connection
+from django.contrib.auth.models import User
+
+from oauthsp.bulk import import_rows
+from oauthsp.models import Consumer, Token, Nonce, random_string
+
+# Synthetic data for the scaling benchmarks. The default shape
+# (SIZES) is 100k users and consumers, 10M tokens and 100M
+# nonces, scaled by the given factor. Rows get explicit ids after
+# the current maximum, so generating on top of existing data is
+# fine. A few consumers get most of the tokens (token ids are
+# hashed to a consumer index skewed by SKEW), most tokens are
+# access tokens, and nonces belong to existing tokens.
+
+SIZES = (
+    (User, 100000),
+    (Consumer, 100000),
+    (Token, 10000000),
+    (Nonce, 100000000),
+)
+
+SKEW = 3
+DAYS = 365
+TOKEN_TYPES = 'A' * 16 + 'R' * 3 + 'S'
+DURATIONS = (3600, 86400, 30 * 86400, 365 * 86400)
+
+def max_id(model):
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    cursor.execute('SELECT MAX(%s) FROM %s' % (qn('id'), qn(model._meta.db_table)))
+    return cursor.fetchone()[0] or 0
+
+def skewed(n, r):
+    """Maps r in [0, 1) to an index in [0, n), heavily biased
+    towards the lowest ones"""
+    return int(n * r ** SKEW)
+
+def hashed(i):
+    # Cheap, deterministic r in [0, 1) for an id
+    return ((i * 2654435761) % 4294967296) / 4294967296.0
+
+def random_date(now):
+    return now - timedelta(seconds=random.randint(0, DAYS * 86400))
+
+def users(start, count):
+    for pk in xrange(start, start + count):
+        yield {
+            'id': pk,
+            'username': 'synthetic%d' % pk,
+            'email': 'synthetic%d@example.com' % pk,
+            'password': '!',
+        }
+
+def consumers(start, count, first_user, user_count):
+    now = datetime.now()
+    for pk in xrange(start, start + count):
+        date = random_date(now)
+        yield {
+            'id': pk,
+            'user_id': first_user + skewed(user_count, random.random()),
+            'key': random_string(32),
+            'secret': random_string(32),
+            'name': u'Synthetic consumer %d' % pk,
+            'version': u'1.0',
+            'consumer_type': random.choice('DMW'),
+            'private': random.random() < 0.1,
+            'developer_email': u'dev%d@example.com' % pk,
+            'uri': u'http://example.com/%d' % pk,
+            'description': u' '.join([random_string(random.randint(3, 10)) \
+                for i in range(random.randint(5, 40))]),
+            'registration_date': date,
+            'updated_date': date,
+        }
+
+def token_consumer(token_id, first_consumer, consumer_count):
+    return first_consumer + skewed(consumer_count, hashed(token_id))
+
+def tokens(start, count, first_consumer, consumer_count, first_user, user_count):
+    now = datetime.now()
+    for pk in xrange(start, start + count):
+        token_type = random.choice(TOKEN_TYPES)
+        date = random_date(now)
+        calls = token_type == 'A' and skewed(10000, random.random()) or 0
+        yield {
+            'id': pk,
+            'key': random_string(32),
+            'secret': random_string(32),
+            'session_handle': random_string(32),
+            'consumer_id': token_consumer(pk, first_consumer, consumer_count),
+            'token_type': token_type,
+            'user_id': token_type != 'R' and first_user + random.randrange(user_count) or None,
+            'creation_date': date,
+            'duration': random.choice(DURATIONS),
+            'can_renew': random.random() < 0.5,
+            'calls': calls,
+            'last_used': calls and date + timedelta(seconds=random.randint(0, 86400)) or None,
+            'revoked': random.random() < 0.02,
+        }
+
+def nonces(start, count, first_token, token_count, first_consumer, consumer_count):
+    for pk in xrange(start, start + count):
+        token_id = first_token + skewed(token_count, random.random())
+        consumer_id = token_consumer(token_id, first_consumer, consumer_count)
+        if random.random() < 0.3:
+            # request_token calls have no token
+            token_id = None
+        value = random_string(16)
+        yield {
+            'id': pk,
+            'consumer_id': consumer_id,
+            'token_id': token_id,
+            'value': value,
+            # Same as Nonce.save()
+            'digest': hashlib.sha1('%s:%s:%s' % (consumer_id, token_id or '', value)).hexdigest(),
+        }
+
+def generate(scale=1.0, progress=None):
+    """Inserts scale times SIZES rows. progress is called with the
+    model and the rows inserted so far. Returns a dict mapping
+    every model to its (first id, row count)."""
+    counts = dict([(model, max(1, int(size * scale))) for model, size in SIZES])
+    generated = {}
+    def insert(model, rows):
+        start = max_id(model) + 1
+        report = progress and (lambda count: progress(model, count))
+        import_rows(model, rows(start, counts[model]), progress=report)
+        generated[model] = (start, counts[model])
+        return start, counts[model]
+
+    user_range = insert(User, users)
+    consumer_range = insert(Consumer, lambda start, count: consumers(start, count, *user_range))
+    token_range = insert(Token, lambda start, count: tokens(start, count,
+        *(consumer_range + user_range)))
+    insert(Nonce, lambda start, count: nonces(start, count,
+        *(token_range + consumer_range)))
+    return generated
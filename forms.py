@@ -20,13 +20,13 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from cStringIO import StringIO
 from PIL import Image
 
 from django import forms
 from django.utils.translation import ugettext, ugettext_lazy as _
 from django.utils.safestring import mark_safe
 from models import Consumer
+from oauthsp.search import name_taken
 
 def seconds_to_string(value):
     months, remaining = divmod(value, 18144000)
@@ -54,11 +54,9 @@ class ConsumerForm(forms.ModelForm):
 
     def clean_name(self):
         name = self.cleaned_data['name']
-        try:
-            Consumer.objects.get(name=name)
+        if name_taken(name):
             raise forms.ValidationError(_('This name is already taken'))
-        except Consumer.DoesNotExist:
-            return name
+        return name
 
     def clean_image(self):
         fobj = self.cleaned_data['image']
@@ -69,21 +67,17 @@ class ConsumerForm(forms.ModelForm):
         if fobj.size > 1024 * 1024:
             raise forms.ValidationError(_('This image is too big. Maximum file size is 1 MiB'))
         fobj.seek(0)
-        im = Image.open(StringIO(fobj.read()))
+        # PIL only parses the header here, decoding and
+        # thumbnailing happen later in oauthsp.images
+        try:
+            im = Image.open(fobj)
+        except IOError:
+            raise forms.ValidationError(_('This file is not a valid image'))
         w, h = im.size
         if w < 128 or h < 128:
             raise forms.ValidationError(_('This image is too small. Minimum size is 128x128'))
         if w != h:
             raise forms.ValidationError(_('This image is not square'))
-
-        im.thumbnail((128, 128))
-        self.big_image = StringIO()
-        im.save(self.big_image, format='PNG')
-        self.big_image.seek(0)
-        im.thumbnail((64, 64))
-        self.small_image = StringIO()
-        im.save(self.small_image, format='PNG')
-        self.small_image.seek(0)
         fobj.seek(0)
 
         return fobj
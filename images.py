@@ -0,0 +1,168 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import atexit
+import logging
+import tempfile
+import threading
+import Queue
+from cStringIO import StringIO
+from PIL import Image
+
+from django.conf import settings
+from django.db import connection
+
+from oauthsp.models import Consumer, StoredImage
+from oauthsp.viewcache import invalidate_consumer
+
+# Consumer images are decoded and thumbnailed by a bounded pool
+# of worker threads, so the request only has to copy the upload
+# to a temporary file. Set OAUTH_IMAGE_WORKERS to 0 to process
+# them inline (e.g. while testing). Jobs still queued when the
+# process exits are processed before it does, so no upload is
+# lost and no temporary file is left behind.
+
+IMAGE_WORKERS = getattr(settings, 'OAUTH_IMAGE_WORKERS', 2)
+IMAGE_QUEUE_SIZE = getattr(settings, 'OAUTH_IMAGE_QUEUE_SIZE', 100)
+IMAGE_WEBP = getattr(settings, 'OAUTH_CONSUMER_IMAGE_WEBP', False)
+
+def webp_supported():
+    Image.init()
+    return IMAGE_WEBP and 'WEBP' in Image.SAVE
+
+def encode_image(im, format):
+    buf = StringIO()
+    im.save(buf, format=format)
+    buf.seek(0)
+    return buf
+
+def render_thumbnails(im):
+    """Returns a dict mapping Consumer fields to (filename, data)
+    for every rendition of the given image."""
+    renditions = {}
+    im.thumbnail((128, 128))
+    renditions['image'] = ('image.png', encode_image(im, 'PNG'))
+    if webp_supported():
+        renditions['webp_image'] = ('image.webp', encode_image(im, 'WEBP'))
+    im.thumbnail((64, 64))
+    renditions['small_image'] = ('image.png', encode_image(im, 'PNG'))
+    return renditions
+
+def process_image(consumer_id, path):
+    try:
+        im = Image.open(path)
+        im.load()
+        renditions = render_thumbnails(im)
+    finally:
+        os.unlink(path)
+
+    try:
+        consumer = Consumer.objects.get(id=consumer_id)
+    except Consumer.DoesNotExist:
+        return
+
+    old = [pk for pk in (consumer.image_id, consumer.small_image_id,
+        consumer.webp_image_id) if pk]
+    values = {'webp_image': None}
+    for field, (name, data) in renditions.items():
+        values[field] = StoredImage.acquire(name, data).stored_file_id
+
+    Consumer.objects.filter(id=consumer_id).update(**values)
+    # update() doesn't send post_save
+    invalidate_consumer(consumer_id)
+    # Release after changing the foreign keys. Unchanged
+    # images were acquired again, so they are kept
+    for pk in old:
+        StoredImage.release(pk)
+
+class ImageJobQueue(object):
+    def __init__(self, workers, size):
+        self.workers = workers
+        self.queue = Queue.Queue(size)
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self.work,
+                    name='oauthsp-image-%d' % len(self.threads))
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def put(self, consumer_id, path):
+        if not self.workers:
+            process_image(consumer_id, path)
+            return
+
+        self.start()
+        try:
+            self.queue.put_nowait((consumer_id, path))
+        except Queue.Full:
+            # All the workers are busy, don't drop the image
+            process_image(consumer_id, path)
+
+    def run(self, consumer_id, path):
+        try:
+            process_image(consumer_id, path)
+        except Exception:
+            logging.exception('Error processing image for consumer %s' % consumer_id)
+
+    def work(self):
+        while True:
+            consumer_id, path = self.queue.get()
+            try:
+                self.run(consumer_id, path)
+            finally:
+                # Every thread gets its own connection
+                connection.close()
+
+    def flush(self):
+        """Processes the queued jobs from the calling thread"""
+        while True:
+            try:
+                consumer_id, path = self.queue.get_nowait()
+            except Queue.Empty:
+                break
+            self.run(consumer_id, path)
+
+image_queue = ImageJobQueue(IMAGE_WORKERS, IMAGE_QUEUE_SIZE)
+atexit.register(image_queue.flush)
+
+def enqueue_image(consumer, fobj):
+    """Copies the uploaded image to a temporary file and
+    queues it for processing. The consumer shows a placeholder
+    until its thumbnails are ready."""
+    fd, path = tempfile.mkstemp(prefix='oauthsp-image-')
+    out = os.fdopen(fd, 'wb')
+    try:
+        for chunk in fobj.chunks():
+            out.write(chunk)
+    finally:
+        out.close()
+
+    image_queue.put(consumer.id, path)
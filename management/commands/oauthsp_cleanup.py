@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+from datetime import datetime, timedelta
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db.models import Q
+
+from oauthsp.models import Token
+from oauthsp.revocation import purge_revoked_tokens
+
+class Command(NoArgsCommand):
+    help = 'Deletes expired tokens and, optionally, access tokens which' \
+        ' have not been used in a long time. Renewable access tokens' \
+        ' are kept until they can no longer be renewed.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--unused-days', dest='unused_days', type='int', default=None,
+            help='Also delete access tokens not used in this many days'),
+    )
+
+    def handle_noargs(self, **options):
+        now = datetime.now()
+        # Tokens are flagged as revoked with set based UPDATEs
+        # and deleted by the batched purge
+        live = Token.objects.filter(revoked=False)
+        renewable = Q(token_type='A', can_renew=True)
+        count = live.filter(expiration_date__lt=now).exclude(renewable).update(revoked=True)
+        # Token.is_renewable() allows renewing for twice the
+        # duration, there are only a few distinct durations
+        durations = live.filter(renewable).values_list('duration', flat=True).distinct()
+        for duration in list(durations):
+            count += live.filter(renewable, duration=duration,
+                creation_date__lt=now - timedelta(seconds=2 * duration)).update(revoked=True)
+        print 'Revoked %d expired tokens' % count
+
+        if options.get('unused_days') is not None:
+            cutoff = now - timedelta(days=options['unused_days'])
+            # Tokens never used since last_used was added are
+            # judged by their creation date
+            count = Token.access.filter(Q(last_used__lt=cutoff) |
+                Q(last_used__isnull=True, creation_date__lt=cutoff)).update(revoked=True)
+            print 'Revoked %d tokens unused since %s' % (count, cutoff)
+
+        for table, count in sorted(purge_revoked_tokens().items()):
+            print 'Deleted %d rows from %s' % (count, table)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from oauthsp import bulk
+
+class Command(BaseCommand):
+    help = 'Exports consumers, tokens or token attributes as JSON lines or CSV.'
+    args = 'consumers|tokens|attributes'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+            help='Output format: jsonl (default) or csv'),
+        make_option('--output', dest='output', default=None,
+            help='Write to this file instead of stdout'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Usage: oauthsp_export %s' % self.args)
+        if options['format'] not in bulk.FORMATS:
+            raise CommandError('Unknown format "%s"' % options['format'])
+        try:
+            model = bulk.get_model(args[0])
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        fobj = options['output'] and open(options['output'], 'wb') or sys.stdout
+        start = time.time()
+        def progress(count):
+            sys.stderr.write('%d rows, %.0f rows/s\n' % (count, count / (time.time() - start)))
+        try:
+            count = bulk.export_rows(model, fobj, options['format'], progress)
+        finally:
+            if fobj is not sys.stdout:
+                fobj.close()
+        elapsed = time.time() - start
+        sys.stderr.write('Exported %d rows in %.2fs (%.0f rows/s)\n' % \
+            (count, elapsed, count / max(elapsed, 0.001)))
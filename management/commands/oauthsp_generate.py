@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from oauthsp import dataset
+
+class Command(NoArgsCommand):
+    help = 'Bulk loads synthetic users, consumers, tokens and nonces for' \
+        ' the scaling benchmarks. Never run it against production data.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--scale', dest='scale', type='float', default=1.0,
+            help='Fraction of the full size (100k consumers, 10M tokens, 100M nonces)'),
+    )
+
+    def handle_noargs(self, **options):
+        start = time.time()
+        def progress(model, count):
+            if not count % 100000:
+                sys.stderr.write('%s: %d rows, %.0f rows/s\n' % (model._meta.db_table,
+                    count, count / (time.time() - start)))
+
+        generated = dataset.generate(options['scale'], progress)
+        for model, (first, count) in generated.items():
+            print 'Inserted %d rows into %s, ids %d to %d' % (count,
+                model._meta.db_table, first, first + count - 1)
+        print 'Done in %.0fs. Run oauthsp_reindex to index the new consumers.' % \
+            (time.time() - start)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from oauthsp import bulk
+
+class Command(BaseCommand):
+    help = 'Imports consumers, tokens or token attributes from JSON lines' \
+        ' or CSV, keeping their ids, keys and secrets. Run' \
+        ' oauthsp_reindex after importing consumers.'
+    args = 'consumers|tokens|attributes file'
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='jsonl',
+            help='Input format: jsonl (default) or csv'),
+        make_option('--chunk-size', dest='chunk_size', type='int',
+            default=bulk.CHUNK_SIZE, help='Rows inserted per statement batch'),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError('Usage: oauthsp_import %s' % self.args)
+        if options['format'] not in bulk.FORMATS:
+            raise CommandError('Unknown format "%s"' % options['format'])
+        try:
+            model = bulk.get_model(args[0])
+        except ValueError, e:
+            raise CommandError(str(e))
+
+        fobj = args[1] == '-' and sys.stdin or open(args[1], 'rb')
+        start = time.time()
+        def progress(count):
+            sys.stderr.write('%d rows, %.0f rows/s\n' % (count, count / (time.time() - start)))
+        try:
+            count = bulk.import_rows(model, bulk.read_rows(fobj, options['format']),
+                options['chunk_size'], progress)
+        finally:
+            if fobj is not sys.stdin:
+                fobj.close()
+        elapsed = time.time() - start
+        sys.stderr.write('Imported %d rows in %.2fs (%.0f rows/s)\n' % \
+            (count, elapsed, count / max(elapsed, 0.001)))
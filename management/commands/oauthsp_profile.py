@@ -0,0 +1,64 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import pstats
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from oauthsp.profiling import PROFILE_DIR
+
+class Command(BaseCommand):
+    help = 'Merges the sampled profiles into a report of the hottest functions.'
+    args = '[directory]'
+    option_list = BaseCommand.option_list + (
+        make_option('--top', dest='top', type='int', default=30,
+            help='Number of functions to show'),
+        make_option('--sort', dest='sort', default='cumulative',
+            help='pstats sort key: cumulative (default), time, calls...'),
+        make_option('--entry-point', dest='entry_point', default=None,
+            help='Only merge the profiles of this entry point'),
+    )
+
+    def handle(self, *args, **options):
+        directory = args and args[0] or PROFILE_DIR
+        if not directory:
+            raise CommandError('No directory given and OAUTH_PROFILE_DIR is not set')
+        if not os.path.isdir(directory):
+            raise CommandError('%s is not a directory' % directory)
+
+        prefix = options['entry_point'] and '%s-' % options['entry_point'] or ''
+        paths = [os.path.join(directory, n) for n in sorted(os.listdir(directory))
+            if n.endswith('.prof') and n.startswith(prefix)]
+        if not paths:
+            raise CommandError('No profiles found in %s' % directory)
+
+        stats = pstats.Stats(paths[0])
+        for path in paths[1:]:
+            try:
+                stats.add(path)
+            except (IOError, EOFError):
+                # Pruned or still being written
+                pass
+        print 'Merged %d profiles from %s' % (len(paths), directory)
+        stats.strip_dirs().sort_stats(options['sort']).print_stats(options['top'])
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from oauthsp.revocation import purge_revoked_tokens, PURGE_BATCH_SIZE
+
+class Command(NoArgsCommand):
+    help = 'Deletes revoked tokens, with their nonces and attributes, in batches.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--batch-size', dest='batch_size', type='int',
+            default=PURGE_BATCH_SIZE, help='Tokens deleted per transaction'),
+        make_option('--pause', dest='pause', type='float', default=0,
+            help='Seconds to sleep between batches'),
+    )
+
+    def handle_noargs(self, **options):
+        start = time.time()
+        deleted = purge_revoked_tokens(options['batch_size'], options['pause'])
+        for table, count in sorted(deleted.items()):
+            print 'Deleted %d rows from %s' % (count, table)
+        print 'Done in %.2fs' % (time.time() - start)
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from oauthsp.capture import capture_log, replay_record
+
+def percentile(values, p):
+    return values[int(round((len(values) - 1) * p / 100.0))]
+
+def read_lines(paths, limit):
+    count = 0
+    for path in paths:
+        fobj = open(path, 'rb')
+        try:
+            for line in fobj:
+                if limit and count >= limit:
+                    return
+                if line.strip():
+                    count += 1
+                    yield line
+        finally:
+            fobj.close()
+
+class Command(BaseCommand):
+    help = 'Replays captured requests through the OAuth validation' \
+        ' pipeline against the local database and reports throughput' \
+        ' and latency percentiles.'
+    args = 'capture_log [capture_log ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--processes', dest='processes', type='int',
+            default=multiprocessing.cpu_count(), help='Number of worker processes'),
+        make_option('--limit', dest='limit', type='int', default=0,
+            help='Replay at most this many requests'),
+    )
+
+    def handle(self, *args, **options):
+        if not args:
+            raise CommandError('Usage: oauthsp_replay %s' % self.args)
+
+        # Don't capture the replayed requests again
+        capture_log.writer = None
+        # Every worker must open its own connection
+        connection.close()
+        pool = multiprocessing.Pool(options['processes'])
+        latencies = []
+        outcomes = {}
+        start = time.time()
+        try:
+            for elapsed, outcome in pool.imap_unordered(replay_record,
+                read_lines(args, options['limit']), 50):
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+                if not outcome.startswith('unsigned'):
+                    latencies.append(elapsed)
+        finally:
+            pool.close()
+            pool.join()
+        wall = time.time() - start
+
+        total = sum(outcomes.values())
+        if not total:
+            raise CommandError('No requests found')
+        print 'Replayed %d requests in %.2fs with %d processes (%.0f requests/s)' % \
+            (total, wall, options['processes'], total / wall)
+        if latencies:
+            latencies.sort()
+            print 'Latency p50 %.2fms, p90 %.2fms, p99 %.2fms' % tuple([1000 * \
+                percentile(latencies, p) for p in (50, 90, 99)])
+        for outcome, count in sorted(outcomes.items()):
+            print '%-40s %d' % (outcome, count)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+from datetime import datetime
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+from django.contrib.auth.models import User
+
+from oauthsp.models import Consumer
+from oauthsp.revocation import revoke_tokens
+
+class Command(NoArgsCommand):
+    help = 'Revokes every token of a consumer, of a user or created' \
+        ' before a date. Conditions given together must all match.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--consumer', dest='consumer', default=None,
+            help='Key of the consumer whose tokens are revoked'),
+        make_option('--user', dest='user', default=None,
+            help='Username of the user whose tokens are revoked'),
+        make_option('--before', dest='before', default=None,
+            help='Revoke tokens created before this date (YYYY-MM-DD)'),
+    )
+
+    def handle_noargs(self, **options):
+        conditions = {}
+        try:
+            if options['consumer']:
+                conditions['consumer'] = Consumer.objects.get(key=options['consumer'])
+            if options['user']:
+                conditions['user'] = User.objects.get(username=options['user'])
+        except (Consumer.DoesNotExist, User.DoesNotExist), e:
+            raise CommandError(str(e))
+        if options['before']:
+            try:
+                conditions['before'] = datetime.strptime(options['before'], '%Y-%m-%d')
+            except ValueError:
+                raise CommandError('Invalid date "%s"' % options['before'])
+        if not conditions:
+            raise CommandError('Give at least one of --consumer, --user or --before')
+
+        start = time.time()
+        count = revoke_tokens(**conditions)
+        print 'Revoked %d tokens in %.2fs' % (count, time.time() - start)
+        print 'Run oauthsp_purge to delete them'
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from oauthsp.snapshot import SNAPSHOT_PATH, write_snapshot
+
+class Command(BaseCommand):
+    help = 'Rebuilds the memory mapped consumer snapshot, at' \
+        ' OAUTH_CONSUMER_SNAPSHOT or at the given path.'
+    args = '[path]'
+
+    def handle(self, *args, **options):
+        path = args and args[0] or SNAPSHOT_PATH
+        if not path:
+            raise CommandError('No path given and OAUTH_CONSUMER_SNAPSHOT is not set')
+
+        start = time.time()
+        count = write_snapshot(path)
+        print 'Wrote %d consumers to %s in %.2fs' % (count, path, time.time() - start)
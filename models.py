@@ -22,37 +22,59 @@
 
 from datetime import datetime, timedelta
 from urllib import urlencode
+from cStringIO import StringIO
 from PIL import Image
+import hashlib
 import random
+import threading
+import os
 
 from django.conf import settings
-from django.db import models
+from django.db import models, connection, transaction, IntegrityError
+from django.db.models import signals
 from django.utils.translation import ugettext_lazy as _
+from django.utils.encoding import smart_str
 from django.contrib.auth.models import User
 
 from decorators import stored_property
-from oauthsp import signatures, exceptions, castings
+from oauthsp import signatures, exceptions
+from oauthsp.schema import AttributeSchema, parse_attributes
+from oauthsp.paginator import invalidate_cached_counts
+from oauthsp.viewcache import invalidate_consumer
+from oauthsp.negcache import consumer_misses, token_misses
 from storage.models import StoredFile
 
+# Keep a serialized copy of the token attributes in
+# Token.attributes, so reading them needs no query and tokens
+# without attributes don't get an attributes row
+TOKEN_ATTRS_INLINE = getattr(settings, 'OAUTH_TOKEN_ATTRS_INLINE', False)
+
 TOKEN_FORM = None
 TOKEN_ATTRS_MODEL = None
+TOKEN_ATTRS_LOCK = threading.Lock()
 
 def get_token_attrs_model():
     return (TOKEN_ATTRS_MODEL or set_token_attrs_model())
 
 def set_token_attrs_model():
     global TOKEN_ATTRS_MODEL
-    if hasattr(settings, 'OAUTH_TOKEN_ATTRS_MODEL') and settings.OAUTH_TOKEN_ATTRS_MODEL:
-        app_label, model_name = settings.OAUTH_TOKEN_ATTRS_MODEL.split('.')
-        model = models.get_model(app_label, model_name)
-        for field in model._meta.local_fields:
-            if field.name not in ('id', 'token'):
-                model.FIELD_CASTINGS[field.name] = castings.get_field_cast(field)
-
-    else:
-        model = EmptyAttributes
-
-    return model
+    TOKEN_ATTRS_LOCK.acquire()
+    try:
+        if TOKEN_ATTRS_MODEL is not None:
+            return TOKEN_ATTRS_MODEL
+
+        if hasattr(settings, 'OAUTH_TOKEN_ATTRS_MODEL') and settings.OAUTH_TOKEN_ATTRS_MODEL:
+            app_label, model_name = settings.OAUTH_TOKEN_ATTRS_MODEL.split('.')
+            model = models.get_model(app_label, model_name)
+            model.schema = AttributeSchema(model)
+            model.FIELD_CASTINGS = model.schema.casters
+        else:
+            model = EmptyAttributes
+
+        TOKEN_ATTRS_MODEL = model
+        return model
+    finally:
+        TOKEN_ATTRS_LOCK.release()
 
 def get_token_form():
     return (TOKEN_FORM or set_token_form())
@@ -60,8 +82,8 @@ def get_token_form():
 def set_token_form():
     global TOKEN_FORM
     if not hasattr(settings, 'OAUTH_TOKEN_FORM'):
-        from oauthsp.forms import TokenAttributesForm
-        TOKEN_FORM = TokenAttributesForm
+        from oauthsp.forms import TokenAuthorizationForm
+        TOKEN_FORM = TokenAuthorizationForm
         return TOKEN_FORM
 
     try:
@@ -73,10 +95,38 @@ def set_token_form():
     TOKEN_FORM = form
     return TOKEN_FORM
 
+def get_placeholder_image_url():
+    return getattr(settings, 'OAUTH_CONSUMER_PLACEHOLDER_IMAGE',
+        '%soauthsp/placeholder.png' % settings.MEDIA_URL)
+
 def random_string(length):
     chars = '01234567890abcdefghijklmnopqrstuvwzyz'
     return ''.join([random.choice(chars) for i in range(length)])
 
+def insert_unique(obj):
+    """Saves obj with a single INSERT. If a unique column rejects
+    it, IntegrityError is raised and the connection is left usable
+    for the caller."""
+    if transaction.is_managed():
+        sid = transaction.savepoint()
+        try:
+            obj.save(force_insert=True)
+            transaction.savepoint_commit(sid)
+        except IntegrityError:
+            transaction.savepoint_rollback(sid)
+            raise
+        return
+
+    # Outside managed transactions save() commits by itself, so
+    # a savepoint around it would be released after the COMMIT
+    # destroyed it (an error on PostgreSQL). A failed INSERT
+    # must still be rolled back before running other queries.
+    try:
+        obj.save(force_insert=True)
+    except IntegrityError:
+        transaction.rollback_unless_managed()
+        raise
+
 class Consumer(models.Model):
     CONSUMER_TYPE_CHOICES = (
         ('D', _('Desktop client')),
@@ -93,9 +143,15 @@ class Consumer(models.Model):
     developer_email = models.EmailField(_('Developer email'))
     uri = models.CharField(_('Web'), max_length=255)
     description = models.TextField(_('Description'))
-    image = models.ForeignKey(StoredFile, related_name='consumer_image_set')
-    small_image = models.ForeignKey(StoredFile, related_name='consumer_small_image_set')
+    # Images are filled in by oauthsp.images when their
+    # thumbnails are ready, a placeholder is shown until then
+    image = models.ForeignKey(StoredFile, related_name='consumer_image_set', null=True)
+    small_image = models.ForeignKey(StoredFile, related_name='consumer_small_image_set', null=True)
+    webp_image = models.ForeignKey(StoredFile, related_name='consumer_webp_image_set', null=True)
+    # Successful validate_access calls and currently valid access
+    # tokens, both kept up to date by oauthsp.usage
     score = models.FloatField(default=0)
+    active_tokens = models.IntegerField(default=0)
     registration_date = models.DateTimeField(default=datetime.now)
     updated_date = models.DateTimeField()
     editable_attributes = models.BooleanField(_('Let the users modify the requested token attributes'), default=True)
@@ -105,10 +161,19 @@ class Consumer(models.Model):
         return ('consumer', [self.id])
 
     def get_small_image_url(self):
-        return self.small_image.get_absolute_url()
+        if self.small_image_id is None:
+            return get_placeholder_image_url()
+        return StoredImage.url_for(self, 'small_image')
 
     def get_big_image_url(self):
-        return self.image.get_absolute_url()
+        if self.image_id is None:
+            return get_placeholder_image_url()
+        return StoredImage.url_for(self, 'image')
+
+    def get_webp_image_url(self):
+        if self.webp_image_id is None:
+            return None
+        return StoredImage.url_for(self, 'webp_image')
 
     def save(self, *args, **kwargs):
         self.updated_date = datetime.now()
@@ -117,6 +182,126 @@ class Consumer(models.Model):
             self.secret = random_string(32)
         super(Consumer, self).save(*args, **kwargs)
 
+class StoredImage(models.Model):
+    """
+    Content addressed image. Consumers with the same thumbnail
+    share its StoredFile, which is deleted when the last consumer
+    using it releases it.
+    """
+    digest = models.CharField(max_length=40, unique=True)
+    extension = models.CharField(max_length=8)
+    stored_file = models.ForeignKey(StoredFile, unique=True)
+    refcount = models.IntegerField(default=0)
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('consumer-image', [self.digest, self.extension])
+
+    def add_references(self, count):
+        """Atomically adds count to the refcount. Returns False if
+        the image has been deleted in the meantime."""
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('UPDATE %s SET %s = %s + %%s WHERE %s = %%s' % \
+            (qn(self._meta.db_table), qn('refcount'), qn('refcount'), qn('id')),
+            [count, self.id])
+        transaction.commit_unless_managed()
+        return cursor.rowcount > 0
+
+    @classmethod
+    def acquire(cls, name, data):
+        """Returns the StoredImage for the given contents, storing
+        them only if no other image has the same digest, and adds
+        a reference to it."""
+        contents = data.read()
+        digest = hashlib.sha1(contents).hexdigest()
+        while True:
+            try:
+                image = cls.objects.get(digest=digest)
+            except cls.DoesNotExist:
+                stored_file = StoredFile.store_file(name, StringIO(contents))
+                image = cls(digest=digest, stored_file=stored_file,
+                    extension=os.path.splitext(name)[1][1:])
+                try:
+                    insert_unique(image)
+                except IntegrityError:
+                    # Somebody else stored it first
+                    stored_file.delete()
+                    continue
+
+            if image.add_references(1):
+                return image
+
+    @classmethod
+    def release(cls, stored_file_id):
+        """Drops a reference to the image stored in the given file,
+        deleting it when nothing references it anymore."""
+        try:
+            image = cls.objects.get(stored_file=stored_file_id)
+        except cls.DoesNotExist:
+            # Stored before images were content addressed
+            for obj in StoredFile.objects.filter(id=stored_file_id):
+                obj.delete()
+            return
+
+        image.add_references(-1)
+        # Won't delete it if it was acquired again in the meantime.
+        # Only the caller whose DELETE removed the row deletes the
+        # file, so concurrent releases don't both delete it
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s = %%s AND %s <= 0' % \
+            (qn(cls._meta.db_table), qn('id'), qn('refcount')), [image.id])
+        deleted = cursor.rowcount
+        transaction.commit_unless_managed()
+        if deleted:
+            for obj in StoredFile.objects.filter(id=stored_file_id):
+                obj.delete()
+
+    @classmethod
+    def url_for(cls, consumer, field):
+        """Returns the URL for the image in the given StoredFile
+        field of consumer, with a single query"""
+        try:
+            return cls.objects.get(stored_file=getattr(consumer, '%s_id' % field)).get_absolute_url()
+        except cls.DoesNotExist:
+            # Stored before images were content addressed
+            return getattr(consumer, field).get_absolute_url()
+
+class ConsumerTerm(models.Model):
+    """Entry in the consumer search index, see oauthsp.search"""
+    term = models.CharField(max_length=80, db_index=True)
+    consumer = models.ForeignKey(Consumer)
+    weight = models.IntegerField(default=0)
+
+def invalidate_consumer_caches(sender, instance, **kwargs):
+    invalidate_cached_counts(Consumer)
+    invalidate_consumer(instance.id)
+
+def release_consumer_images(sender, instance, **kwargs):
+    for pk in (instance.image_id, instance.small_image_id, instance.webp_image_id):
+        if pk:
+            StoredImage.release(pk)
+
+def update_consumer_index(sender, instance, **kwargs):
+    from oauthsp.search import index_consumer
+    index_consumer(instance)
+
+def discard_consumer_miss(sender, instance, **kwargs):
+    consumer_misses.discard(instance.key)
+
+def mark_snapshot_changed(sender, instance, **kwargs):
+    from oauthsp.snapshot import mark_changed
+    mark_changed(instance.key)
+
+signals.post_save.connect(invalidate_consumer_caches, sender=Consumer)
+signals.post_save.connect(discard_consumer_miss, sender=Consumer)
+signals.post_save.connect(update_consumer_index, sender=Consumer)
+signals.post_delete.connect(invalidate_consumer_caches, sender=Consumer)
+signals.post_delete.connect(release_consumer_images, sender=Consumer)
+signals.post_save.connect(mark_snapshot_changed, sender=Consumer)
+signals.post_delete.connect(mark_snapshot_changed, sender=Consumer)
+
 #class ConsumerVote(models.Model):
 #    user = models.ForeignKey(User)
 #    consumer = models.ForeignKey(Consumer)
@@ -125,15 +310,15 @@ class Consumer(models.Model):
 
 class RequestedTokenManager(models.Manager):
     def get_query_set(self):
-        return super(RequestedTokenManager, self).get_query_set().filter(token_type='R')
+        return super(RequestedTokenManager, self).get_query_set().filter(token_type='R', revoked=False)
 
 class AuthorizedTokenManager(models.Manager):
     def get_query_set(self):
-        return super(AuthorizedTokenManager, self).get_query_set().filter(token_type='S')
+        return super(AuthorizedTokenManager, self).get_query_set().filter(token_type='S', revoked=False)
 
 class AccessTokenManager(models.Manager):
     def get_query_set(self):
-        return super(AccessTokenManager, self).get_query_set().filter(token_type='A')
+        return super(AccessTokenManager, self).get_query_set().filter(token_type='A', revoked=False)
 
 class Token(models.Model):
     TOKEN_TYPE_CHOICES = (
@@ -152,6 +337,11 @@ class Token(models.Model):
     duration = models.IntegerField(default=3600)
     expiration_date = models.DateTimeField(null=True, db_index=True)
     can_renew = models.BooleanField(default=False)
+    calls = models.IntegerField(default=0)
+    revoked = models.BooleanField(default=False, db_index=True)
+    # See TOKEN_ATTRS_INLINE. NULL for tokens created without it
+    attributes = models.TextField(null=True, blank=True)
+    last_used = models.DateTimeField(null=True, db_index=True)
 
     objects = models.Manager()
     requested = RequestedTokenManager()
@@ -200,9 +390,41 @@ class Token(models.Model):
             self.key = random_string(32)
             self.secret = random_string(32)
             self.session_handle = random_string(32)
+        if TOKEN_ATTRS_INLINE and self.id is None and self.attributes is None:
+            self.attributes = u''
         self.expiration_date = self.creation_date + timedelta(seconds=self.duration)
         super(Token, self).save(*args, **kwargs)
 
+    @classmethod
+    @transaction.commit_on_success
+    def create_request_token(cls, consumer, duration=None, attributes=None):
+        """Issues a request token for consumer (a Consumer or anything
+        with its id) in a single transaction. The token
+        and its attributes are built in memory and written with one
+        INSERT each, the attributes only if there are any. When
+        they're stored inline they go in the token INSERT too, and
+        the attributes row is still written to keep both in sync."""
+        token = cls(consumer_id=consumer.id)
+        if duration is not None:
+            token.duration = duration
+        attrs = None
+        if attributes:
+            attrs = get_token_attrs_model().from_string(token, attributes)
+            if TOKEN_ATTRS_INLINE:
+                token.attributes = attrs.to_string()
+        token.save(force_insert=True)
+        if attrs is not None:
+            attrs.token = token
+            attrs.save(force_insert=True)
+        return token
+
+    def revoke(self):
+        """Marks the token as revoked with a single UPDATE. Its
+        nonces and attributes are deleted later by
+        oauthsp.revocation.purge_revoked_tokens()"""
+        Token.objects.filter(id=self.id).update(revoked=True)
+        self.revoked = True
+
     @stored_property
     def attrs(self):
         return get_token_attrs_model().for_token(self)
@@ -222,59 +444,128 @@ class Token(models.Model):
             ('oauth_token_secret', self.secret),
         ))
 
+def discard_token_miss(sender, instance, **kwargs):
+    token_misses.discard((instance.consumer_id, instance.key))
+
+signals.post_save.connect(discard_token_miss, sender=Token)
+
 class Nonce(models.Model):
     consumer = models.ForeignKey(Consumer, db_index=True)
     token = models.ForeignKey(Token, null=True, db_index=True)
     value = models.CharField(max_length=64, db_index=True)
+    # sha1 of (consumer, token, value), so a replayed nonce
+    # fails to insert instead of needing a SELECT first
+    digest = models.CharField(max_length=40, unique=True)
 
     def save(self, *args, **kwargs):
         self.value = self.value[:64]
+        # Header parameters are unquoted to byte strings
+        self.digest = hashlib.sha1('%s:%s:%s' % (self.consumer_id, self.token_id or '',
+            smart_str(self.value))).hexdigest()
         super(Nonce, self).save(*args, **kwargs)
 
+class AuditEvent(models.Model):
+    """Token lifecycle event, written by oauthsp.audit"""
+    event = models.CharField(max_length=16)
+    date = models.DateTimeField(db_index=True)
+    consumer_id = models.IntegerField(db_index=True)
+    token_key = models.CharField(max_length=32, db_index=True)
+    user_id = models.IntegerField(null=True)
+    remote_addr = models.CharField(max_length=40, blank=True)
+
 class Attributes(models.Model):
     class Meta:
         abstract = True
 
+    # Set by set_token_attrs_model()
+    schema = None
     FIELD_CASTINGS = {}
 
     token = models.ForeignKey(Token)
 
+    def __init__(self, *args, **kwargs):
+        super(Attributes, self).__init__(*args, **kwargs)
+        self._saved_values = None
+        if self.id is not None and self.schema is not None:
+            self._saved_values = self.schema.as_dict(self)
+
     def clean(self):
         pass
 
+    def changed_fields(self):
+        """Returns a dict with the attributes modified since
+        this instance was loaded or last saved."""
+        values = self.schema.as_dict(self)
+        if self._saved_values is None:
+            return values
+        return dict([(k, v) for k, v in values.items() if self._saved_values[k] != v])
+
     def save(self, *args, **kwargs):
         self.clean()
-        super(Attributes, self).save(*args, **kwargs)
+        if self.id is None and TOKEN_ATTRS_INLINE and not (args or kwargs):
+            # Loaded from Token.attributes, the row might not exist
+            changed = self.changed_fields()
+            if not changed:
+                return
+            if not self.__class__.objects.filter(token=self.token_id).update(**changed):
+                super(Attributes, self).save()
+        elif self.id is None or args or kwargs:
+            super(Attributes, self).save(*args, **kwargs)
+        else:
+            # Write only the changed columns, if any
+            changed = self.changed_fields()
+            if not changed:
+                return
+            self.__class__.objects.filter(id=self.id).update(**changed)
+        self._saved_values = self.schema.as_dict(self)
+        if TOKEN_ATTRS_INLINE and self.token.attributes != self.to_string():
+            self.token.attributes = self.to_string()
+            Token.objects.filter(id=self.token_id).update(attributes=self.token.attributes)
 
     def copy_from_form(self, form):
-        for key in self.__class__.FIELD_CASTINGS:
+        for key in self.schema.form_fields:
             setattr(self, key, form.cleaned_data[key])
         self.save()
 
     def set_field_value(self, fieldname, value):
         try:
-            setattr(self, fieldname, self.__class__.FIELD_CASTINGS[fieldname](value))
+            setattr(self, fieldname, self.schema.cast(fieldname, value))
         except (KeyError, ValueError), e:
             pass
 
     def set_attributes(self, attrs):
-        try:
-            for item in attrs.split(';'):
-                field, value = item.split(':', 1)
-                self.set_field_value(field, value)
-            self.save()
-        except (TypeError, AttributeError):
-            pass
+        if not attrs:
+            return
+        for field, value in parse_attributes(attrs):
+            self.set_field_value(field, value)
+        self.save()
 
     def to_string(self):
-        return ';'.join(['%s:%s' % (key, getattr(self, key)) for key in self.__class__.FIELD_CASTINGS])
+        return self.schema.to_string(self)
 
     def as_dict(self):
-        return dict([(k, getattr(self, k)) for k in self.__class__.FIELD_CASTINGS])
+        return self.schema.as_dict(self)
+
+    @classmethod
+    def from_string(cls, token, attrs):
+        """Returns an unsaved instance for token with the values
+        in the given attribute string"""
+        obj = cls(token=token)
+        for field, value in parse_attributes(attrs):
+            obj.set_field_value(field, value)
+        return obj
 
     @classmethod
     def for_token(cls, token):
-        return cls.objects.get_or_create(token=token)[0]
+        if TOKEN_ATTRS_INLINE and token.attributes is not None:
+            attrs = cls.from_string(token, token.attributes)
+            attrs._saved_values = attrs.as_dict()
+            return attrs
+        attrs = cls.objects.get_or_create(token=token)[0]
+        # Share the instance, so a later token.save() keeps
+        # the attributes written by attrs.save()
+        attrs.token = token
+        return attrs
 
 class EmptyAttributes(object):
     def __init__(self, *args, **kwargs):
@@ -292,6 +583,13 @@ class EmptyAttributes(object):
     def to_string(self):
         return u''
 
+    def as_dict(self):
+        return {}
+
+    @classmethod
+    def from_string(cls, token, attrs):
+        return EmptyAttributes()
+
     @classmethod
     def for_token(cls, token):
         return EmptyAttributes()
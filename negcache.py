@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+import threading
+from collections import deque
+
+from django.conf import settings
+
+# Consumer and token keys which were recently looked up and not
+# found, so scanners and broken clients don't cost a query per
+# request. Entries expire after OAUTH_NEGATIVE_CACHE_TTL seconds
+# and are discarded as soon as a consumer or token with that key
+# is saved in this process (see oauthsp.models) or imported by
+# it (see oauthsp.bulk). The cache is per process: the others
+# keep a stale miss until it expires, which only matters for
+# keys imported from elsewhere, since new ones are random.
+
+NEGATIVE_CACHE_SIZE = getattr(settings, 'OAUTH_NEGATIVE_CACHE_SIZE', 10000)
+NEGATIVE_CACHE_TTL = getattr(settings, 'OAUTH_NEGATIVE_CACHE_TTL', 30)
+
+class NegativeCache(object):
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = {}
+        self.order = deque()
+        self.lock = threading.Lock()
+        self.added = 0
+        self.absorbed = 0
+
+    def add(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.entries:
+                self.order.append(key)
+                self.added += 1
+            self.entries[key] = time.time() + self.ttl
+            while len(self.entries) > self.size:
+                self.entries.pop(self.order.popleft(), None)
+            if len(self.order) > 2 * self.size:
+                # Drop the keys which were discarded
+                self.order = deque([k for k in self.order if k in self.entries])
+        finally:
+            self.lock.release()
+
+    def discard(self, key):
+        self.lock.acquire()
+        try:
+            self.entries.pop(key, None)
+        finally:
+            self.lock.release()
+
+    def keys(self):
+        self.lock.acquire()
+        try:
+            return self.entries.keys()
+        finally:
+            self.lock.release()
+
+    def __contains__(self, key):
+        self.lock.acquire()
+        try:
+            expires = self.entries.get(key)
+            if expires is None:
+                return False
+            if expires < time.time():
+                del self.entries[key]
+                return False
+            self.absorbed += 1
+            return True
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """Returns the number of keys currently cached, the number
+        of misses added and the number of lookups absorbed."""
+        return {
+            'entries': len(self.entries),
+            'added': self.added,
+            'absorbed': self.absorbed,
+        }
+
+consumer_misses = NegativeCache(NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL)
+token_misses = NegativeCache(NEGATIVE_CACHE_SIZE, NEGATIVE_CACHE_TTL)
+
+def get_stats():
+    return {
+        'consumers': consumer_misses.get_stats(),
+        'tokens': token_misses.get_stats(),
+    }
@@ -20,76 +20,123 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-from django.utils.translation import ugettext as _
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.utils.translation import ugettext as _, get_language
 from django.utils.safestring import mark_safe
+from django.utils.http import urlquote
+from django.db.models import Q
 from django.http import Http404
 
+from oauthsp.utils import get_generation, bump_generation
+
+COUNT_EXACT = 'exact'
+COUNT_CACHED = 'cached'
+COUNT_ESTIMATE = 'estimate'
+COUNT_LOOKAHEAD = 'lookahead'
+
+# Below this many rows the DB statistics are too
+# coarse and a cached exact count is used instead
+ESTIMATE_THRESHOLD = 10000
+
+def _model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def invalidate_cached_counts(model):
+    """Drops every cached count for querysets over model."""
+    bump_generation('count.%s' % _model_label(model))
+
 class InvalidPage(Exception):
     pass
 
 class PageList(object):
+    """
+    Renders the links to the pages around the current one. URLs
+    are built straight from the paginator, without creating any
+    Page objects. If the paginator has a page_list_cache_timeout,
+    the markup is cached by (base_url, current page, num_pages,
+    adjacent_count).
+    """
     def __init__(self, paginator):
-        self.curpage = paginator.page(paginator.curpage)
+        self.paginator = paginator
+        self.number = int(paginator.curpage or 1)
         self.adjacent_count = paginator.adjacent_count
 
     def __repr__(self):
         return '<PageList current: %d - total: %d>' % \
-            (self.curpage.paginator.curpage, self.curpage.paginator.num_pages)
-
-    def _add_range_as_element(self, open, close, start, end):
-        markup = ''
-        for i in range(start, end + 1):
-            page = self.curpage.paginator.page(i)
-            if self.curpage.number == i:
-                markup += '%s<a class="curpage">%d</a>%s' % \
-                    (open, i, close)
+            (self.number, self.paginator.num_pages)
+
+    def _add_prev_next(self, parts, el, subel_open, subel_close, previous_url, next_url):
+        parts.append('%s<%s class="prev-next">' % (subel_open, el))
+        if previous_url:
+            parts.append('%s<a href="%s">&laquo; %s</a>%s' % \
+                    (subel_open, previous_url, _('Previous'), subel_close))
+        if next_url:
+            parts.append('%s<a href="%s">%s &raquo;</a>%s' % \
+                    (subel_open, next_url, _('Next'), subel_close))
+        parts.append('</%s>%s' % (el, subel_close))
+
+    def _add_range(self, parts, el, cls, subel_open, subel_close, start, end):
+        url = self.paginator.url
+        parts.append('%s<%s class="%s">' % (subel_open, el, cls))
+        for i in xrange(start, end + 1):
+            if i == self.number:
+                parts.append('%s<a class="curpage">%d</a>%s' % \
+                    (subel_open, i, subel_close))
             else:
-                markup += '%s<a href="%s">%d</a>%s' % \
-                    (open, page.url(), i, close)
-        return markup
-
-    def _as_html(self, el, subel_open, subel_close):
-        if not self.curpage.has_other_pages():
+                parts.append('%s<a href="%s">%d</a>%s' % \
+                    (subel_open, url(i), i, subel_close))
+        parts.append('</%s>%s' % (el, subel_close))
+
+    def _render(self, el, subel_open, subel_close):
+        number = self.number
+        num_pages = self.paginator.num_pages
+        if number <= 1 and number >= num_pages:
             return u''
 
-        markup = '<%s class="pagelist">' % el
-
-        markup += '%s<%s class="prev-next">' % (subel_open, el)
-        if self.curpage.has_previous():
-            markup += '%s<a href="%s">&laquo; %s</a>%s' % \
-                    (subel_open, self.curpage.previous_page_url(),
-                    _('Previous'), subel_close)
-        if self.curpage.has_next():
-            markup += '%s<a href="%s">%s &raquo;</a>%s' % \
-                    (subel_open, self.curpage.next_page_url(),
-                    _('Next'), subel_close)
-        markup += '</%s>%s' % (el, subel_close)
+        url = self.paginator.url
+        parts = ['<%s class="pagelist">' % el]
+        self._add_prev_next(parts, el, subel_open, subel_close,
+                number > 1 and url(number - 1),
+                number < num_pages and url(number + 1))
 
-        num_pages = self.curpage.paginator.num_pages
-        midstart = max(self.curpage.number - self.adjacent_count, 1)
-        midend = min(self.curpage.number + self.adjacent_count, num_pages)
+        midstart = max(number - self.adjacent_count, 1)
+        midend = min(number + self.adjacent_count, num_pages)
 
         if midstart > 1:
-            end = min(self.adjacent_count + 1, midstart - 1)
-            markup += '%s<%s class="start">' % (subel_open, el)
-            markup += self._add_range_as_element(subel_open,
-                    subel_close, 1, end)
-            markup += '</%s>%s' % (el, subel_close)
+            self._add_range(parts, el, 'start', subel_open, subel_close,
+                    1, min(self.adjacent_count + 1, midstart - 1))
 
-        markup += '%s<%s class="middle">' % (subel_open, el)
-        markup += self._add_range_as_element(subel_open, subel_close,
-                    midstart, midend)
-        markup += '</%s>%s' % (el, subel_close)
+        self._add_range(parts, el, 'middle', subel_open, subel_close,
+                midstart, midend)
 
         if midend < num_pages:
-            start = max(num_pages - self.adjacent_count, midend + 1)
-            markup += '%s<%s class="end">' % (subel_open, el)
-            markup += self._add_range_as_element(subel_open, subel_close,
-                    start, self.curpage.paginator.num_pages)
-            markup += '</%s>%s' % (el, subel_close)
+            self._add_range(parts, el, 'end', subel_open, subel_close,
+                    max(num_pages - self.adjacent_count, midend + 1), num_pages)
 
-        markup += '</%s>' % el
+        parts.append('</%s>' % el)
+        return u''.join(parts)
 
+    def _as_html(self, el, subel_open, subel_close):
+        timeout = self.paginator.page_list_cache_timeout
+        if not timeout:
+            return mark_safe(self._render(el, subel_open, subel_close))
+
+        paginator = self.paginator
+        key = 'oauthsp.pagelist.%s' % md5(repr((paginator.base_url,
+            paginator.page_suffix, paginator.query_string, self.number,
+            paginator.num_pages, self.adjacent_count, el, get_language()))).hexdigest()
+        markup = cache.get(key)
+        if markup is None:
+            markup = self._render(el, subel_open, subel_close)
+            cache.set(key, markup, timeout)
         return mark_safe(markup)
 
     def as_ul(self):
@@ -98,15 +145,52 @@ class PageList(object):
     def as_div(self):
         return self._as_html('div', '', '')
 
+class KeysetPageList(PageList):
+    """
+    PageList for KeysetPaginator. Pages are reached by seeking
+    from their neighbours, so only the first, previous and next
+    pages can be linked.
+    """
+    def __init__(self, page):
+        self.page = page
+        self.paginator = page.paginator
+        self.number = page.number
+        self.adjacent_count = page.paginator.adjacent_count
+
+    def __repr__(self):
+        return '<KeysetPageList current: %d>' % self.number
+
+    def _render(self, el, subel_open, subel_close):
+        page = self.page
+        if not page.has_other_pages():
+            return u''
+
+        parts = ['<%s class="pagelist">' % el]
+        self._add_prev_next(parts, el, subel_open, subel_close,
+                page.has_previous() and page.previous_page_url(),
+                page.has_next() and page.next_page_url())
+        if self.number > 1:
+            self._add_range(parts, el, 'start', subel_open, subel_close, 1, 1)
+        self._add_range(parts, el, 'middle', subel_open, subel_close,
+                self.number, self.number)
+        parts.append('</%s>' % el)
+        return u''.join(parts)
+
+    def _as_html(self, el, subel_open, subel_close):
+        # Links depend on the cursor, so they can't be cached
+        return mark_safe(self._render(el, subel_open, subel_close))
+
 
 class Paginator(object):
-    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, base_url=None, page_suffix=None, adjacent_count=2, current=None):
+    def __init__(self, object_list, per_page, orphans=0, allow_empty_first_page=True, base_url=None, page_suffix=None, adjacent_count=2, current=None, query_string=None, page_list_cache_timeout=None):
         self.object_list = object_list
         self.per_page = per_page
         self.orphans = orphans
         self.allow_empty_first_page = allow_empty_first_page
         self.base_url = base_url
         self.page_suffix = page_suffix
+        self.query_string = query_string
+        self.page_list_cache_timeout = page_list_cache_timeout
         self.curpage = current
         self.adjacent_count = adjacent_count
         self._num_pages = self._count = None
@@ -143,6 +227,17 @@ class Paginator(object):
         except InvalidPage:
             raise Http404(_('Invalid page'))
 
+    def url(self, number):
+        if number == 1:
+            url = self.base_url
+        else:
+            url = self.base_url + self.page_suffix % number
+
+        if self.query_string:
+            return '%s?%s' % (url, self.query_string)
+
+        return url
+
     def _get_count(self):
         "Returns the total number of objects, across all pages."
         if self._count is None:
@@ -177,11 +272,91 @@ class Paginator(object):
 
 class QuerySetPaginator(Paginator):
     """
-    Like Paginator, but works on QuerySets.
+    Like Paginator, but works on QuerySets. count_strategy selects
+    how the total number of objects is obtained:
+
+        COUNT_EXACT: SELECT COUNT(*) every time (the default).
+        COUNT_CACHED: exact count, cached for count_ttl seconds and
+            dropped by invalidate_cached_counts().
+        COUNT_ESTIMATE: row estimate from the DB statistics for the
+            whole table, so it ignores any filtering. Falls back to
+            COUNT_CACHED for small tables or unsupported backends.
+        COUNT_LOOKAHEAD: no count at all. The first page() fetches
+            per_page + 1 rows, so only pages up to the next one
+            are known to exist. Every page() fetches its rows
+            this way, even past the pages known so far.
     """
+    def __init__(self, *args, **kwargs):
+        self.count_strategy = kwargs.pop('count_strategy', COUNT_EXACT)
+        self.count_ttl = kwargs.pop('count_ttl', 300)
+        super(QuerySetPaginator, self).__init__(*args, **kwargs)
+
+    def page(self, number):
+        if self.count_strategy != COUNT_LOOKAHEAD:
+            return super(QuerySetPaginator, self).page(number)
+
+        try:
+            number = int(number)
+        except ValueError:
+            raise InvalidPage('That page number is not an integer')
+        if number < 1:
+            raise InvalidPage('That page number is less than 1')
+
+        bottom = (number - 1) * self.per_page
+        rows = list(self.object_list[bottom:bottom + self.per_page + 1])
+        if not rows and number > 1:
+            raise InvalidPage('That page contains no results')
+
+        # Never forget pages a previous page() found
+        self._count = max(self._count, bottom + len(rows))
+        self._num_pages = max(self._num_pages,
+            number + (len(rows) > self.per_page and 1 or 0))
+        if self.curpage is None:
+            self.curpage = number
+        return Page(rows[:self.per_page], number, self)
+
+    def _cached_count(self):
+        key = 'oauthsp.count.%s.%s' % \
+            (get_generation('count.%s' % _model_label(self.object_list.model)),
+            md5(str(self.object_list.query)).hexdigest())
+        count = cache.get(key)
+        if count is None:
+            count = self.object_list.count()
+            cache.set(key, count, self.count_ttl)
+        return count
+
+    def _estimated_count(self):
+        table = self.object_list.model._meta.db_table
+        cursor = connection.cursor()
+        if settings.DATABASE_ENGINE.startswith('postgresql'):
+            cursor.execute('SELECT reltuples FROM pg_class WHERE relname = %s', [table])
+            column = 0
+        elif settings.DATABASE_ENGINE == 'mysql':
+            cursor.execute('SHOW TABLE STATUS LIKE %s', [table])
+            column = 4
+        else:
+            return None
+
+        row = cursor.fetchone()
+        if row is None or row[column] is None:
+            return None
+        return int(row[column])
+
     def _get_count(self):
         if self._count is None:
-            self._count = self.object_list.count()
+            if self.count_strategy == COUNT_ESTIMATE:
+                estimate = self._estimated_count()
+                if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                    self._count = estimate
+                else:
+                    self._count = self._cached_count()
+            elif self.count_strategy == COUNT_CACHED:
+                self._count = self._cached_count()
+            elif self.count_strategy == COUNT_LOOKAHEAD:
+                # Fetching the current page yields the known count
+                self.page(self.curpage or 1)
+            else:
+                self._count = self.object_list.count()
         return self._count
     count = property(_get_count)
 
@@ -210,16 +385,13 @@ class Page(object):
         return self.number - 1
 
     def next_page_url(self):
-        return Page(self.object_list, self.number + 1, self.paginator).url()
+        return self.paginator.url(self.number + 1)
 
     def previous_page_url(self):
-        return Page(self.object_list, self.number - 1, self.paginator).url()
+        return self.paginator.url(self.number - 1)
 
     def url(self):
-        if self.number == 1:
-            return self.paginator.base_url
-
-        return self.paginator.base_url + self.paginator.page_suffix % self.number
+        return self.paginator.url(self.number)
 
     def start_index(self):
         """
@@ -237,6 +409,163 @@ class Page(object):
             return self.paginator.count
         return self.number * self.paginator.per_page
 
+class KeysetPaginator(object):
+    """
+    Paginates a QuerySet by seeking past the last seen (sort key, id)
+    pair instead of slicing with OFFSET, so deep pages cost the same
+    as the first one. The cursor travels in the query string, while
+    the page number in the path is only used for display. Pages
+    requested by number without a cursor (e.g. old bookmarks) fall
+    back to OFFSET slicing.
+    """
+    def __init__(self, object_list, per_page, order_field, base_url=None, page_suffix=None, adjacent_count=2, query_string=None, cursor_param='cursor'):
+        self.object_list = object_list
+        self.per_page = per_page
+        self.base_url = base_url
+        self.page_suffix = page_suffix
+        self.adjacent_count = adjacent_count
+        self.query_string = query_string
+        self.cursor_param = cursor_param
+        self.descending = order_field.startswith('-')
+        self.key_field = order_field.lstrip('-')
+        self.field = object_list.model._meta.get_field(self.key_field)
+        self.curpage = None
+        self.current = None
+
+    def validate_number(self, number):
+        "Validates the given 1-based page number."
+        try:
+            number = int(number)
+        except ValueError:
+            raise InvalidPage('That page number is not an integer')
+        if number < 1:
+            raise InvalidPage('That page number is less than 1')
+        return number
+
+    def encode_cursor(self, obj, backwards=False):
+        value = getattr(obj, self.key_field)
+        if isinstance(value, float):
+            # unicode() keeps only 12 significant digits
+            value = repr(value)
+        return u'%s%d,%s' % (backwards and 'b' or 'a', obj.id, value)
+
+    def decode_cursor(self, cursor):
+        try:
+            head, value = cursor.split(',', 1)
+            if head[0] not in ('a', 'b'):
+                raise ValueError
+            return head[0] == 'b', int(head[1:]), self.field.to_python(value)
+        except (ValueError, IndexError, TypeError, ValidationError):
+            raise InvalidPage('Invalid cursor')
+
+    def _ordered(self, descending):
+        prefix = descending and '-' or ''
+        return self.object_list.order_by(prefix + self.key_field, prefix + 'id')
+
+    def _seek(self, backwards, pk, value):
+        # Walking backwards flips the sort order, so rows
+        # come in reverse and must be reversed afterwards
+        descending = self.descending != backwards
+        op = descending and 'lt' or 'gt'
+        after_key = Q(**{'%s__%s' % (self.key_field, op): value})
+        same_key = Q(**{self.key_field: value, 'id__%s' % op: pk})
+        return self._ordered(descending).filter(after_key | same_key)
+
+    def page(self, number, cursor=None):
+        "Returns a KeysetPage for the given 1-based page number and cursor."
+        number = self.validate_number(number)
+        if cursor:
+            backwards, pk, value = self.decode_cursor(cursor)
+            rows = list(self._seek(backwards, pk, value)[:self.per_page + 1])
+            more = len(rows) > self.per_page
+            rows = rows[:self.per_page]
+            if backwards:
+                rows.reverse()
+                has_previous, has_next = more, True
+            else:
+                has_previous, has_next = True, more
+        else:
+            bottom = (number - 1) * self.per_page
+            rows = list(self._ordered(self.descending)[bottom:bottom + self.per_page + 1])
+            has_previous, has_next = number > 1, len(rows) > self.per_page
+            rows = rows[:self.per_page]
+
+        if not rows and (number > 1 or cursor):
+            raise InvalidPage('That page contains no results')
+
+        self.curpage = number
+        self.current = KeysetPage(rows, number, self, has_previous, has_next)
+        return self.current
+
+    def page_or_404(self, number, cursor=None):
+        try:
+            return self.page(number, cursor)
+        except InvalidPage:
+            raise Http404(_('Invalid page'))
+
+    def url(self, number, cursor=None):
+        url = self.base_url
+        if number > 1:
+            url += self.page_suffix % number
+        params = []
+        if self.query_string:
+            params.append(self.query_string)
+        if cursor:
+            params.append('%s=%s' % (self.cursor_param, urlquote(cursor)))
+        if params:
+            url = '%s?%s' % (url, '&'.join(params))
+
+        return url
+
+    def _get_page_list(self):
+        return KeysetPageList(self.current)
+    page_list = property(_get_page_list)
+
+class KeysetPage(object):
+    def __init__(self, object_list, number, paginator, has_previous, has_next):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __repr__(self):
+        return '<KeysetPage %s>' % self.number
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self.has_previous() or self.has_next()
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    def next_page_url(self):
+        return self.paginator.url(self.number + 1,
+            self.paginator.encode_cursor(self.object_list[-1]))
+
+    def previous_page_url(self):
+        # The first page is always linked without a cursor, so
+        # it shows the newest rows even if some were inserted
+        if self.number <= 2:
+            return self.paginator.url(1)
+
+        return self.paginator.url(self.number - 1,
+            self.paginator.encode_cursor(self.object_list[0], backwards=True))
+
+    def start_index(self):
+        return (self.paginator.per_page * (self.number - 1)) + 1
+
+    def end_index(self):
+        return self.start_index() + len(self.object_list) - 1
+
 class ObjectPaginator(Paginator):
     """
     Legacy ObjectPaginator class, for backwards compatibility.
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import time
+import cProfile
+import itertools
+import threading
+from functools import wraps
+
+from django.conf import settings
+
+# Sampled profiling of the oauthsp entry points. With
+# OAUTH_PROFILE_DIR set, 1 in OAUTH_PROFILE_SAMPLE calls of every
+# entry point runs under cProfile and its stats are dumped to
+# that directory, which keeps the newest OAUTH_PROFILE_KEEP dumps.
+# With OAUTH_PROFILE_SLOW set, only dumps of calls which took at
+# least that many seconds are kept, and an unsampled call that
+# slow makes the next call to the same entry point be profiled.
+# Unsampled calls only pay for a counter and a clock read. See
+# the oauthsp_profile command for merging the dumps.
+
+PROFILE_DIR = getattr(settings, 'OAUTH_PROFILE_DIR', None)
+PROFILE_SAMPLE = getattr(settings, 'OAUTH_PROFILE_SAMPLE', 100)
+PROFILE_SLOW = getattr(settings, 'OAUTH_PROFILE_SLOW', None)
+PROFILE_KEEP = getattr(settings, 'OAUTH_PROFILE_KEEP', 1000)
+
+_local = threading.local()
+
+def prune_dumps(directory, keep):
+    names = [n for n in os.listdir(directory) if n.endswith('.prof')]
+    if len(names) <= keep:
+        return
+    paths = [os.path.join(directory, n) for n in names]
+    paths.sort(key=lambda p: os.path.getmtime(p))
+    for path in paths[:len(paths) - keep]:
+        try:
+            os.unlink(path)
+        except OSError:
+            # Removed by another process
+            pass
+
+def dump_path(directory, name, elapsed):
+    return os.path.join(directory, '%s-%d-%d-%d-%dms.prof' % (name,
+        int(time.time()), os.getpid(), threading.currentThread().ident or 0,
+        elapsed * 1000))
+
+def sample_profile(name):
+    """Decorator profiling a sample of the calls to the decorated
+    entry point, see above."""
+    def decorator(func):
+        if not PROFILE_DIR:
+            return func
+
+        counter = itertools.count()
+        armed = []
+
+        def wrapper(*args, **kwargs):
+            sampled = (PROFILE_SAMPLE and counter.next() % PROFILE_SAMPLE == 0) or armed
+            if not sampled or getattr(_local, 'active', False):
+                start = time.time()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    if PROFILE_SLOW and time.time() - start >= PROFILE_SLOW:
+                        armed[:] = [True]
+
+            del armed[:]
+            profiler = cProfile.Profile()
+            _local.active = True
+            start = time.time()
+            try:
+                return profiler.runcall(func, *args, **kwargs)
+            finally:
+                elapsed = time.time() - start
+                _local.active = False
+                if not PROFILE_SLOW or elapsed >= PROFILE_SLOW:
+                    if not os.path.isdir(PROFILE_DIR):
+                        try:
+                            os.makedirs(PROFILE_DIR)
+                        except OSError:
+                            # Created by another process
+                            pass
+                    profiler.dump_stats(dump_path(PROFILE_DIR, name, elapsed))
+                    prune_dumps(PROFILE_DIR, PROFILE_KEEP)
+
+        return wraps(func)(wrapper)
+    return decorator
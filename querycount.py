@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.db import connection
+
+from oauthsp.utils import Stats
+
+# Counts and times the queries run by each oauthsp entry point.
+# Views and OAuthRequest.validate_access annotate the HttpRequest
+# with request.oauthsp_queries, a dict mapping the entry point
+# name to its QueryCounter, and totals are kept per process.
+# Set OAUTH_QUERY_STATS to False to turn it off.
+
+QUERY_STATS = getattr(settings, 'OAUTH_QUERY_STATS', True)
+
+stats = Stats()
+
+class CountingCursor(object):
+    def __init__(self, cursor, counter):
+        self.cursor = cursor
+        self.counter = counter
+
+    def execute(self, sql, params=()):
+        start = time.time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.counter.record(sql, time.time() - start)
+
+    def executemany(self, sql, param_list):
+        start = time.time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.counter.record(sql, time.time() - start)
+
+    def __getattr__(self, attr):
+        return getattr(self.cursor, attr)
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class QueryCounter(object):
+    """
+    Counts the queries run by the current thread between start()
+    and stop(). The connection is thread local, so other threads
+    are not affected. Counters can be nested.
+    """
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.queries = []
+        self._previous = None
+
+    def record(self, sql, elapsed):
+        self.count += 1
+        self.time += elapsed
+        self.queries.append(sql)
+
+    def start(self):
+        self._previous = connection.__dict__.get('cursor')
+        make_cursor = connection.cursor
+        counter = self
+        def cursor():
+            return CountingCursor(make_cursor(), counter)
+        connection.cursor = cursor
+
+    def stop(self):
+        if self._previous is None:
+            del connection.cursor
+        else:
+            connection.cursor = self._previous
+
+def get_stats():
+    """Returns a dict mapping every entry point to a (calls,
+    queries, seconds spent in queries) tuple for this process."""
+    return dict(stats.items())
+
+def count_queries(name, get_request=lambda args: args[0]):
+    """Decorator for oauthsp entry points. get_request receives
+    the positional arguments and returns the HttpRequest to
+    annotate (the first argument by default, as in views)."""
+    def decorator(func):
+        if not QUERY_STATS:
+            return func
+
+        def wrapper(*args, **kwargs):
+            counter = QueryCounter()
+            counter.start()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                counter.stop()
+                stats.add(name, 1, counter.count, counter.time)
+                request = get_request(args)
+                if not hasattr(request, 'oauthsp_queries'):
+                    request.oauthsp_queries = {}
+                request.oauthsp_queries[name] = counter
+
+        return wraps(func)(wrapper)
+    return decorator
+
+class QueryBudgetMixin(object):
+    """Mixin for TestCases checking the number of queries run."""
+    def assertQueryBudget(self, budget, func, *args, **kwargs):
+        counter = QueryCounter()
+        counter.start()
+        try:
+            result = func(*args, **kwargs)
+        finally:
+            counter.stop()
+        if counter.count > budget:
+            self.fail('%d queries run, the budget is %d:\n%s' % \
+                (counter.count, budget, '\n'.join(counter.queries)))
+        return result
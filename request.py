@@ -24,11 +24,18 @@ import time
 from datetime import datetime
 
 from django.http import HttpRequest
+from django.db import transaction, IntegrityError
 
 from oauthsp import exceptions
 from oauthsp.signatures import get_signature_method
-from oauthsp.utils import quote, unquote
-from oauthsp.models import Consumer, Token, Nonce
+from oauthsp.utils import quote, unquote, split_query
+from oauthsp.models import Consumer, Token, Nonce, insert_unique
+from oauthsp.usage import usage_counter
+from oauthsp.negcache import consumer_misses, token_misses
+from oauthsp.querycount import count_queries
+from oauthsp.profiling import sample_profile
+from oauthsp.capture import capture_log
+from oauthsp.snapshot import get_consumer
 
 OAUTH_PREFIX = 'oauth_'
 VERSION = '1.0'
@@ -36,14 +43,49 @@ VERSION = '1.0'
 class OAuthRequest(object):
     def __init__(self, request):
         self.request = request
-        self.consumer = None
+        # The Consumer, or its snapshot until something else than
+        # the id or secret is needed (see oauthsp.snapshot)
+        self.signing_consumer = None
+        self._consumer = None
         self.token = None
 
+    def _get_consumer(self):
+        if self._consumer is None and self.signing_consumer is not None:
+            self._consumer = Consumer.objects.get(id=self.signing_consumer.id)
+        return self._consumer
+
+    def _set_consumer(self, consumer):
+        self.signing_consumer = self._consumer = consumer
+    consumer = property(_get_consumer, _set_consumer)
+
     def base_uri(self):
         return '%s://%s%s' % (self.request.is_secure() and 'https' or 'http',
                 self.request.get_host().lower(), self.request.path)
 
     def normalized_params(self):
+        """Normalizes the raw query string and form body, without
+        decoding them, when the request provides them."""
+        if 'QUERY_STRING' not in self.request.META:
+            return self.decoded_normalized_params()
+
+        key_values = []
+        if self.has_oauth_header():
+            for k, v in self.OAUTH.items():
+                if k != 'signature':
+                    key_values.append((quote(OAUTH_PREFIX + k), quote(v)))
+
+        sources = [self.request.META['QUERY_STRING']]
+        if self.request.method == 'POST' and \
+            self.request.META.get('CONTENT_TYPE') == 'application/x-www-form-urlencoded':
+
+            sources.append(self.request.raw_post_data)
+        for qs in sources:
+            key_values.extend([kv for kv in split_query(qs) if kv[0] != 'oauth_signature'])
+        key_values.sort()
+
+        return u'&'.join([u'%s=%s' % kv for kv in key_values])
+
+    def decoded_normalized_params(self):
         key_values = []
         if self.has_oauth_header():
             for k, v in self.OAUTH.items():
@@ -118,16 +160,29 @@ class OAuthRequest(object):
         return self._oauth
 
     def validate_consumer(self):
+        key = self.OAUTH.get('consumer_key')
+        if key is None or key in consumer_misses:
+            raise exceptions.OAuthInvalidConsumerError
+        self._consumer = None
+        self.signing_consumer = get_consumer(key)
+        if self.signing_consumer is not None:
+            return
         try:
-            self.consumer = Consumer.objects.get(key=self.OAUTH['consumer_key'])
-        except (KeyError, Consumer.DoesNotExist):
+            self.consumer = Consumer.objects.get(key=key)
+        except Consumer.DoesNotExist:
+            consumer_misses.add(key)
             raise exceptions.OAuthInvalidConsumerError
 
     def validate_token(self):
         if self.OAUTH.get('token'):
+            miss = (self.signing_consumer.id, self.OAUTH['token'])
+            if miss in token_misses:
+                raise exceptions.OAuthInvalidTokenError
             try:
-                self.token = Token.objects.get(consumer=self.consumer, key=self.OAUTH['token'])
+                self.token = Token.objects.get(consumer=self.signing_consumer.id,
+                    key=self.OAUTH['token'], revoked=False)
             except Token.DoesNotExist:
+                token_misses.add(miss)
                 raise exceptions.OAuthInvalidTokenError
 
     def validate_timestamp(self):
@@ -146,12 +201,15 @@ class OAuthRequest(object):
 
     def validate_nonce(self):
         try:
-            nonce, cr = Nonce.objects.get_or_create(consumer=self.consumer,
-                    token=self.token, value=self.OAUTH['nonce'])
+            nonce = Nonce(consumer_id=self.signing_consumer.id, token=self.token,
+                value=self.OAUTH['nonce'])
         except KeyError:
             raise exceptions.OAuthInvalidNonceError
 
-        if not cr:
+        # A single INSERT, the unique digest rejects replays
+        try:
+            insert_unique(nonce)
+        except IntegrityError:
             raise exceptions.OAuthInvalidNonceError
 
     def validate_signature(self):
@@ -160,6 +218,7 @@ class OAuthRequest(object):
             raise exceptions.OAuthInvalidSignatureError
 
     def validate(self):
+        capture_log.capture(self.request)
         self.validate_version()
         self.validate_timestamp()
         self.validate_consumer()
@@ -167,12 +226,15 @@ class OAuthRequest(object):
         self.validate_nonce()
         self.validate_signature()
 
+    @count_queries('validate_access', lambda args: args[0].request)
+    @sample_profile('validate_access')
     def validate_access(self):
         self.validate()
         if not self.token or not self.token.is_access():
             raise exceptions.OAuthInvalidTokenError
         if self.token.expiration_date < datetime.now():
             raise exceptions.OAuthTokenExpiredError
+        usage_counter.count(self.token)
 
     def validate_session(self):
         try:
@@ -181,16 +243,14 @@ class OAuthRequest(object):
         except KeyError:
             raise exceptions.OAuthMissingParamError
 
+    @transaction.commit_on_success
     def generate_request_token(self):
         self.validate()
-        token = Token(consumer=self.consumer)
         try:
             duration = int(self.OAUTH.get('token_duration'))
-            token.duration = duration
         except (TypeError, ValueError):
-            pass
+            duration = None
 
-        token.save()
-        token.attrs.set_attributes(self.OAUTH.get('token_attributes'))
-        return token
+        return Token.create_request_token(self.signing_consumer, duration,
+            self.OAUTH.get('token_attributes'))
 
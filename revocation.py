@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.dispatch import Signal
+
+from oauthsp.models import Token, Nonce, EmptyAttributes, get_token_attrs_model
+from oauthsp.viewcache import invalidate_consumer
+
+# Revoked tokens are only flagged while handling the request.
+# Their nonces, attributes and the tokens themselves are deleted
+# later, in batches, by purge_revoked_tokens() (see the
+# oauthsp_purge command), so no single transaction holds locks
+# for long.
+
+PURGE_BATCH_SIZE = getattr(settings, 'OAUTH_PURGE_BATCH_SIZE', 500)
+
+# Sent once per revoke_tokens() call, after the UPDATE
+tokens_revoked = Signal(providing_args=['consumer_ids', 'count'])
+
+def revoke_tokens(consumer=None, user=None, before=None):
+    """Revokes every token matching all the given conditions: issued
+    to consumer, authorized by user or created before the given
+    datetime. consumer and user may be instances or ids. Returns
+    the number of tokens revoked."""
+    if consumer is None and user is None and before is None:
+        raise ValueError('No conditions given, refusing to revoke every token')
+
+    qn = connection.ops.quote_name
+    where = ['%s = %%s' % qn('revoked')]
+    params = [False]
+    if consumer is not None:
+        where.append('%s = %%s' % qn('consumer_id'))
+        params.append(getattr(consumer, 'id', consumer))
+    if user is not None:
+        where.append('%s = %%s' % qn('user_id'))
+        params.append(getattr(user, 'id', user))
+    if before is not None:
+        where.append('%s < %%s' % qn('creation_date'))
+        params.append(before)
+
+    table = qn(Token._meta.db_table)
+    where = ' AND '.join(where)
+    cursor = connection.cursor()
+    cursor.execute('SELECT DISTINCT %s FROM %s WHERE %s' % (qn('consumer_id'),
+        table, where), params)
+    consumer_ids = [row[0] for row in cursor.fetchall()]
+    cursor.execute('UPDATE %s SET %s = %%s WHERE %s' % (table, qn('revoked'),
+        where), [True] + params)
+    count = cursor.rowcount
+    transaction.commit_unless_managed()
+    tokens_revoked.send(sender=Token, consumer_ids=consumer_ids, count=count)
+    return count
+
+def invalidate_revoked(sender, consumer_ids, **kwargs):
+    for consumer_id in consumer_ids:
+        invalidate_consumer(consumer_id)
+
+tokens_revoked.connect(invalidate_revoked, sender=Token)
+
+def delete_in(cursor, model, column, ids):
+    qn = connection.ops.quote_name
+    cursor.execute('DELETE FROM %s WHERE %s IN (%s)' % (qn(model._meta.db_table),
+        qn(column), ', '.join(['%s'] * len(ids))), ids)
+    return cursor.rowcount
+
+def purge_revoked_tokens(batch_size=PURGE_BATCH_SIZE, pause=0):
+    """Deletes revoked tokens and their dependent rows, batch_size
+    tokens at a time, sleeping pause seconds between batches.
+    Returns a dict with the number of rows deleted per table."""
+    qn = connection.ops.quote_name
+    dependents = [Nonce]
+    attrs_model = get_token_attrs_model()
+    if attrs_model is not EmptyAttributes:
+        dependents.append(attrs_model)
+
+    sql = 'SELECT %s FROM %s WHERE %s = %%s LIMIT %d' % (qn('id'),
+        qn(Token._meta.db_table), qn('revoked'), batch_size)
+    deleted = dict([(model._meta.db_table, 0) for model in dependents + [Token]])
+    cursor = connection.cursor()
+    while True:
+        cursor.execute(sql, [True])
+        ids = [row[0] for row in cursor.fetchall()]
+        if not ids:
+            break
+        for model in dependents:
+            deleted[model._meta.db_table] += delete_in(cursor, model, 'token_id', ids)
+        deleted[Token._meta.db_table] += delete_in(cursor, Token, 'id', ids)
+        transaction.commit_unless_managed()
+        if pause:
+            time.sleep(pause)
+
+    return deleted
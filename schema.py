@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re
+
+from oauthsp import castings
+
+# Attribute strings look like k:v;k:v. A backslash escapes
+# ';', ':' and itself, so values may contain any of them.
+
+TOKEN_RE = re.compile(r'\\(.)|([^\\;:]+)|([;:])', re.S)
+ESCAPE_RE = re.compile(r'([\\;:])')
+
+def parse_attributes(s):
+    """Returns the (key, value) pairs in an attribute string.
+    Items without a key are ignored."""
+    items = []
+    parts = []
+    key = None
+    for escaped, text, separator in TOKEN_RE.findall(s):
+        if separator == ';':
+            if key is not None:
+                items.append((key, u''.join(parts)))
+            key = None
+            parts = []
+        elif separator == ':' and key is None:
+            key = u''.join(parts)
+            parts = []
+        else:
+            parts.append(escaped or text or separator)
+
+    if key is not None:
+        items.append((key, u''.join(parts)))
+    return items
+
+def escape_value(value):
+    return ESCAPE_RE.sub(r'\\\1', value)
+
+def format_attributes(items):
+    return u';'.join([u'%s:%s' % (key, escape_value(value)) for key, value in items])
+
+class AttributeSchema(object):
+    """
+    Token attributes model compiled once: the attribute names,
+    their casters (string -> value) and serializers (value ->
+    string) and the fields copied from the authorization form.
+    """
+    def __init__(self, model):
+        self.model = model
+        fields = [f for f in model._meta.local_fields if f.name not in ('id', 'token')]
+        self.names = tuple([f.name for f in fields])
+        self.casters = dict([(f.name, castings.get_field_cast(f)) for f in fields])
+        self.serializers = tuple([(f.name, castings.get_field_serializer(f)) for f in fields])
+        self.form_fields = self.names
+
+    def cast(self, name, value):
+        return self.casters[name](value)
+
+    def to_string(self, obj):
+        return format_attributes([(name, serialize(getattr(obj, name)))
+            for name, serialize in self.serializers])
+
+    def as_dict(self, obj):
+        return dict([(name, getattr(obj, name)) for name in self.names])
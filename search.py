@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import re
+
+from django.db import connection, transaction
+
+from oauthsp.models import Consumer, ConsumerTerm
+
+# Inverted index over the public consumer directory. Terms
+# are kept in ConsumerTerm and updated incrementally every
+# time a consumer is saved, see oauthsp.models.
+
+FIELD_WEIGHTS = (
+    ('name', 3),
+    ('uri', 2),
+    ('description', 1),
+)
+
+# Exact names are indexed too, for the uniqueness check
+NAME_PREFIX = u'='
+
+MAX_TERM_LENGTH = 64
+
+TERM_RE = re.compile(r'\w+', re.UNICODE)
+
+def tokenize(text):
+    return [term[:MAX_TERM_LENGTH] for term in TERM_RE.findall(text.lower())]
+
+def consumer_terms(consumer):
+    terms = {NAME_PREFIX + consumer.name: 0}
+    for field, weight in FIELD_WEIGHTS:
+        for term in tokenize(getattr(consumer, field)):
+            terms[term] = terms.get(term, 0) + weight
+    return terms
+
+def index_consumer(consumer):
+    """Brings the index for the consumer up to date, writing
+    only the terms which changed."""
+    terms = consumer_terms(consumer)
+    current = dict(ConsumerTerm.objects.filter(consumer=consumer).values_list('term', 'weight'))
+    removed = [term for term in current if term not in terms]
+    changed = [(weight, consumer.id, term) for term, weight in terms.items()
+        if term in current and current[term] != weight]
+    added = [(term, consumer.id, weight) for term, weight in terms.items()
+        if term not in current]
+
+    if removed:
+        ConsumerTerm.objects.filter(consumer=consumer, term__in=removed).delete()
+
+    qn = connection.ops.quote_name
+    table = qn(ConsumerTerm._meta.db_table)
+    cursor = connection.cursor()
+    if changed:
+        cursor.executemany('UPDATE %s SET %s = %%s WHERE %s = %%s AND %s = %%s' % \
+            (table, qn('weight'), qn('consumer_id'), qn('term')), changed)
+    if added:
+        cursor.executemany('INSERT INTO %s (%s, %s, %s) VALUES (%%s, %%s, %%s)' % \
+            (table, qn('term'), qn('consumer_id'), qn('weight')), added)
+    transaction.commit_unless_managed()
+
+def index_unindexed():
+    """Indexes the consumers without any term (every indexed one
+    has its name), e.g. the ones inserted by oauthsp.bulk, which
+    don't send post_save. Returns how many were indexed."""
+    count = 0
+    for consumer in Consumer.objects.exclude(
+        id__in=ConsumerTerm.objects.values('consumer')).iterator():
+        index_consumer(consumer)
+        count += 1
+    return count
+
+def name_taken(name):
+    return ConsumerTerm.objects.filter(term=NAME_PREFIX + name).count() > 0
+
+# Deepest result reachable by paging, so counting the
+# matches of common terms doesn't read the whole index
+MAX_RESULTS = 1000
+
+class SearchResults(object):
+    """
+    Ids of the public consumers matching any of the terms.
+    Consumers matching more terms come first, ties are broken
+    by the sum of the weights of the matched terms. Slices run
+    a query with LIMIT and OFFSET and len() counts at most
+    MAX_RESULTS matches, so it can be given to a Paginator.
+    """
+    def __init__(self, terms):
+        self.terms = terms
+        self._count = None
+
+    def _execute(self, sql, params):
+        qn = connection.ops.quote_name
+        query = 'SELECT t.%(consumer_id)s FROM %(terms)s t' \
+            ' INNER JOIN %(consumers)s c ON c.%(id)s = t.%(consumer_id)s' \
+            ' WHERE t.%(term)s IN (%(params)s) AND c.%(private)s = %%s' \
+            ' GROUP BY t.%(consumer_id)s' \
+            ' ORDER BY COUNT(*) DESC, SUM(t.%(weight)s) DESC, t.%(consumer_id)s' % {
+                'consumer_id': qn('consumer_id'),
+                'terms': qn(ConsumerTerm._meta.db_table),
+                'consumers': qn(Consumer._meta.db_table),
+                'id': qn('id'),
+                'term': qn('term'),
+                'params': ', '.join(['%s'] * len(self.terms)),
+                'private': qn('private'),
+                'weight': qn('weight'),
+            }
+        cursor = connection.cursor()
+        cursor.execute(sql % query, self.terms + [False] + params)
+        return cursor.fetchall()
+
+    def __len__(self):
+        if self._count is None:
+            if not self.terms:
+                self._count = 0
+            else:
+                self._count = self._execute('SELECT COUNT(*) FROM (%s LIMIT %%s) matches',
+                    [MAX_RESULTS])[0][0]
+        return self._count
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        start = k.start or 0
+        stop = min(k.stop is None and MAX_RESULTS or k.stop, MAX_RESULTS)
+        if not self.terms or stop <= start:
+            return []
+        return [row[0] for row in self._execute('%s LIMIT %%s OFFSET %%s',
+            [stop - start, start])]
+
+def search(query):
+    """Returns the SearchResults for the terms in query."""
+    return SearchResults(list(set(tokenize(query))))
@@ -60,10 +60,10 @@ class OAuthSignature(object):
     def get_key(self, request):
         if request.token:
             return '%s&%s' % \
-                (quote(request.consumer.secret),
+                (quote(request.signing_consumer.secret),
                 quote(request.token.secret))
 
-        return '%s&' % quote(request.consumer.secret)
+        return '%s&' % quote(request.signing_consumer.secret)
 
     def get_base_string(self, request):
         raise NotImplementedError
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import time
+import mmap
+import struct
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from oauthsp.models import Consumer
+from oauthsp.utils import GENERATION_TIMEOUT
+
+# Read only snapshot of the consumer fields needed to validate
+# requests, memory mapped by every worker so they share a single
+# copy and don't query the DB for consumers after a restart.
+# Records are sorted by key and found by binary search. The
+# oauthsp_snapshot command rebuilds the file and renames it over
+# the old one, and workers map the new version as soon as they
+# notice it, at most OAUTH_CONSUMER_SNAPSHOT_CHECK seconds later.
+# Consumers missing from the snapshot are looked up in the DB,
+# and so are the ones saved or deleted after it was built: their
+# post_save and post_delete handlers leave the time of the change
+# in the cache. Every worker must see it, so the snapshot needs a
+# CACHE_BACKEND shared by all the processes (memcached, db or
+# file, not locmem or dummy) and refuses to start otherwise.
+
+SNAPSHOT_PATH = getattr(settings, 'OAUTH_CONSUMER_SNAPSHOT', None)
+SNAPSHOT_CHECK = getattr(settings, 'OAUTH_CONSUMER_SNAPSHOT_CHECK', 5)
+
+MAGIC = 'OSPC'
+VERSION = 2
+# magic, version, number of records, build time
+HEADER = struct.Struct('<4sIId')
+# key, secret, id
+RECORD = struct.Struct('<32s32sI')
+KEY_SIZE = 32
+
+# Backends which keep a separate cache in every process
+PROCESS_CACHES = ('locmem', 'dummy')
+
+def write_snapshot(path):
+    """Writes a snapshot of every consumer to path, atomically
+    replacing any previous one. Returns the number of records."""
+    # Changes made while reading the consumers count as newer
+    built = time.time()
+    rows = [(key.encode('utf-8'), secret.encode('utf-8'), pk) for pk, key, secret in
+        Consumer.objects.values_list('id', 'key', 'secret').iterator()]
+    rows.sort()
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    fobj = open(tmp, 'wb')
+    try:
+        fobj.write(HEADER.pack(MAGIC, VERSION, len(rows), built))
+        for row in rows:
+            fobj.write(RECORD.pack(*row))
+        fobj.flush()
+        os.fsync(fobj.fileno())
+    finally:
+        fobj.close()
+    os.rename(tmp, path)
+    return len(rows)
+
+class ConsumerSnapshot(object):
+    def __init__(self, path, check_interval):
+        self.path = path
+        self.check_interval = check_interval
+        self.checked = 0
+        self.stamp = None
+        # (mmap, number of records, build time), swapped as a whole
+        self.state = (None, 0, 0)
+
+    def _map(self):
+        st = os.stat(self.path)
+        stamp = (st.st_ino, st.st_mtime, st.st_size)
+        if stamp == self.stamp:
+            return
+
+        fobj = open(self.path, 'rb')
+        try:
+            data = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fobj.close()
+        magic, version, count, built = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION or \
+            len(data) != HEADER.size + count * RECORD.size:
+            raise ValueError('Invalid consumer snapshot in %s' % self.path)
+
+        # The old map is closed when no thread is using it anymore
+        self.state = (data, count, built)
+        self.stamp = stamp
+
+    def refresh(self):
+        now = time.time()
+        if now - self.checked < self.check_interval:
+            return
+        self.checked = now
+        try:
+            self._map()
+        except (OSError, IOError, ValueError, struct.error):
+            self.state, self.stamp = (None, 0, 0), None
+
+    def lookup(self, key):
+        """Returns (id, secret) for the consumer key or None,
+        also when the consumer changed after the snapshot was
+        built."""
+        self.refresh()
+        data, count, built = self.state
+        if data is None or len(key) > KEY_SIZE:
+            return None
+
+        key = key.encode('utf-8').ljust(KEY_SIZE, '\0')
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            offset = HEADER.size + mid * RECORD.size
+            if data[offset:offset + KEY_SIZE] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == count:
+            return None
+
+        found, secret, pk = RECORD.unpack_from(data, HEADER.size + lo * RECORD.size)
+        if found != key:
+            return None
+        changed = cache.get(changed_key(found.rstrip('\0')))
+        if changed is not None and changed >= built:
+            return None
+        return pk, secret.rstrip('\0').decode('utf-8')
+
+def changed_key(key):
+    return 'oauthsp.snapshot.changed.%s' % key
+
+def mark_changed(key):
+    """Makes every snapshot built before now ignore the consumer"""
+    cache.set(changed_key(key), time.time(), GENERATION_TIMEOUT)
+
+def check_cache_backend(backend):
+    """Raises ImproperlyConfigured unless the cache backend is
+    shared by every process, see above."""
+    if backend.split(':', 1)[0] in PROCESS_CACHES:
+        raise ImproperlyConfigured('OAUTH_CONSUMER_SNAPSHOT needs a CACHE_BACKEND ' \
+            'shared by every process, "%s" is not' % backend)
+
+if SNAPSHOT_PATH:
+    check_cache_backend(settings.CACHE_BACKEND)
+consumer_snapshot = SNAPSHOT_PATH and ConsumerSnapshot(SNAPSHOT_PATH, SNAPSHOT_CHECK)
+
+class SnapshotConsumer(object):
+    """Consumer fields stored in the snapshot, only enough to
+    check signatures. OAuthRequest loads the Consumer itself
+    when anything else is needed."""
+    __slots__ = ('id', 'key', 'secret')
+
+    def __init__(self, id, key, secret):
+        self.id = id
+        self.key = key
+        self.secret = secret
+
+def get_consumer(key):
+    """Returns a SnapshotConsumer if the snapshot has the key,
+    None otherwise."""
+    if not consumer_snapshot:
+        return None
+    found = consumer_snapshot.lookup(key)
+    if found is None:
+        return None
+    return SnapshotConsumer(found[0], key, found[1])
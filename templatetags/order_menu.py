@@ -36,6 +36,8 @@ def order_menu(parser, token):
 ORDERINGS = (
     (_('Last updated'), 'newest'),
     (_('Name'), 'name'),
+    (_('Most used'), 'popular'),
+    (_('Most active users'), 'active'),
 )
 
 def get_url(request, ordering, new_ordering):
@@ -20,14 +20,49 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
+import time
+import tempfile
 import unittest
+import threading
+from datetime import datetime, timedelta
+from base64 import b64encode
+from cStringIO import StringIO
+from urllib import urlencode, quote as url_quote
+from PIL import Image
 
+from django import forms
+from django.conf import settings
+from django.db import models, connection, transaction
 from django.http import QueryDict
+from django.forms import Form
+from django.test import TestCase
+from django.contrib.auth.models import User
+from django.core.urlresolvers import reverse
+from django.core.exceptions import ImproperlyConfigured
+from django.utils import simplejson
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
 
-from oauthsp.models import Consumer, Token
+import oauthsp.models
+import oauthsp.search
+from oauthsp import bulk, images, snapshot
+from oauthsp.audit import AuditLog
+from oauthsp.capture import request_record
+from oauthsp.exceptions import OAuthInvalidNonceError
+from oauthsp.forms import ConsumerForm
+from oauthsp.models import Attributes, Consumer, Token, Nonce, StoredImage, StoredFile, random_string
+from oauthsp.negcache import NegativeCache, consumer_misses
+from oauthsp.querycount import QueryBudgetMixin
+from oauthsp.usage import usage_counter
+from oauthsp.paginator import Paginator, KeysetPaginator, QuerySetPaginator, InvalidPage, \
+    COUNT_EXACT, COUNT_CACHED, COUNT_ESTIMATE, COUNT_LOOKAHEAD, invalidate_cached_counts
 from oauthsp.request import OAuthRequest
+from oauthsp.revocation import revoke_tokens
+from oauthsp.schema import AttributeSchema, parse_attributes, format_attributes
+from oauthsp.search import tokenize, consumer_terms, name_taken, search as search_consumers
 from oauthsp.signatures import OAuthSignature_HMAC_SHA1
-from oauthsp.utils import quote, unquote
+from oauthsp.utils import Stats, quote, unquote
 
 class MockRequest(object):
     def __init__(self, *attrs, **kw):
@@ -55,6 +90,40 @@ class MockRequest(object):
         return self.secure
 
 class OAuthRequestTestCase(unittest.TestCase):
+    signed_requests = (
+        (
+            'GET',
+            'http://example.com',
+            'n=v',
+            'GET&http%3A%2F%2Fexample.com&n%3Dv'
+        ),
+        (
+            'POST',
+            'https://photos.example.net/request_token',
+                'oauth_version=1.0&oauth_consumer_key=dpf43f3p2l4k3l03&' \
+                'oauth_timestamp=1191242090&oauth_nonce=hsu94j3884jdopsl&' \
+                'oauth_signature_method=PLAINTEXT&oauth_signature=ignored',
+            'POST&https%3A%2F%2Fphotos.example.net%2Frequest_token&oauth' \
+                '_consumer_key%3Ddpf43f3p2l4k3l03%26oauth_nonce%3Dhsu94j' \
+                '3884jdopsl%26oauth_signature_method%3DPLAINTEXT%26oauth' \
+                '_timestamp%3D1191242090%26oauth_version%3D1.0'
+        ),
+        (
+            'GET',
+            'http://photos.example.net/photos',
+                'file=vacation.jpg&size=original&oauth_version=1.0&' \
+                'oauth_consumer_key=dpf43f3p2l4k3l03&oauth_token=nnch' \
+                '734d00sl2jdk&oauth_timestamp=1191242096&oauth_nonce=' \
+                'kllo9940pd9333jh&oauth_signature=ignored&oauth_signa' \
+                'ture_method=HMAC-SHA1',
+            'GET&http%3A%2F%2Fphotos.example.net%2Fphotos&file%3Dvacati' \
+                'on.jpg%26oauth_consumer_key%3Ddpf43f3p2l4k3l03%26oauth' \
+                '_nonce%3Dkllo9940pd9333jh%26oauth_signature_method%3DH' \
+                'MAC-SHA1%26oauth_timestamp%3D1191242096%26oauth_token%3D' \
+                'nnch734d00sl2jdk%26oauth_version%3D1.0%26size%3Doriginal'
+        )
+    )
+
     def testEncoding(self):
         params = (
             (u'abcABC123', u'abcABC123'),
@@ -83,46 +152,25 @@ class OAuthRequestTestCase(unittest.TestCase):
         for qs in query_strings:
             req = OAuthRequest(MockRequest(('GET', qs[0])))
             self.assertEqual(req.normalized_params(), qs[1])
+            req = OAuthRequest(MockRequest(('GET', qs[0]), method='GET',
+                META={'QUERY_STRING': qs[0]}))
+            self.assertEqual(req.normalized_params(), qs[1])
 
     def testConcatenate(self):
-        requests = (
-            (
-                'GET',
-                'http://example.com',
-                'n=v',
-                'GET&http%3A%2F%2Fexample.com&n%3Dv'
-            ),
-            (
-                'POST',
-                'https://photos.example.net/request_token',
-                    'oauth_version=1.0&oauth_consumer_key=dpf43f3p2l4k3l03&' \
-                    'oauth_timestamp=1191242090&oauth_nonce=hsu94j3884jdopsl&' \
-                    'oauth_signature_method=PLAINTEXT&oauth_signature=ignored',
-                'POST&https%3A%2F%2Fphotos.example.net%2Frequest_token&oauth' \
-                    '_consumer_key%3Ddpf43f3p2l4k3l03%26oauth_nonce%3Dhsu94j' \
-                    '3884jdopsl%26oauth_signature_method%3DPLAINTEXT%26oauth' \
-                    '_timestamp%3D1191242090%26oauth_version%3D1.0'
-            ),
-            (
-                'GET',
-                'http://photos.example.net/photos',
-                    'file=vacation.jpg&size=original&oauth_version=1.0&' \
-                    'oauth_consumer_key=dpf43f3p2l4k3l03&oauth_token=nnch' \
-                    '734d00sl2jdk&oauth_timestamp=1191242096&oauth_nonce=' \
-                    'kllo9940pd9333jh&oauth_signature=ignored&oauth_signa' \
-                    'ture_method=HMAC-SHA1',
-                'GET&http%3A%2F%2Fphotos.example.net%2Fphotos&file%3Dvacati' \
-                    'on.jpg%26oauth_consumer_key%3Ddpf43f3p2l4k3l03%26oauth' \
-                    '_nonce%3Dkllo9940pd9333jh%26oauth_signature_method%3DH' \
-                    'MAC-SHA1%26oauth_timestamp%3D1191242096%26oauth_token%3D' \
-                    'nnch734d00sl2jdk%26oauth_version%3D1.0%26size%3Doriginal'
-            )
-        )
-
-        for r in requests:
+        for r in self.signed_requests:
             req = OAuthRequest(MockRequest((r[0], r[2]), method=r[0], uri=r[1]))
             self.assertEqual(req.signature_base_string(), r[3])
 
+    def testRawConcatenate(self):
+        for r in self.signed_requests:
+            if r[0] == 'GET':
+                meta = {'QUERY_STRING': r[2]}
+            else:
+                meta = {'QUERY_STRING': '', 'CONTENT_TYPE': 'application/x-www-form-urlencoded'}
+            req = OAuthRequest(MockRequest((r[0], r[2]), method=r[0], uri=r[1],
+                META=meta, raw_post_data=r[2]))
+            self.assertEqual(req.signature_base_string(), r[3])
+
     def testHMAC_SHA1(self):
         from base64 import b64encode
         cases = (
@@ -142,6 +190,667 @@ class OAuthRequestTestCase(unittest.TestCase):
             text = case[2]
             self.assertEqual(b64encode(OAuthSignature_HMAC_SHA1().sign_string(key, text)), case[3])
 
+class AttributesTestCase(unittest.TestCase):
+    def testParse(self):
+        self.assertEqual(parse_attributes(u'a:1;b:x:y;c;d:'),
+            [(u'a', u'1'), (u'b', u'x:y'), (u'd', u'')])
+        self.assertEqual(parse_attributes(u'a:x\\;y;b:\\\\'),
+            [(u'a', u'x;y'), (u'b', u'\\')])
+        self.assertEqual(parse_attributes(u''), [])
+
+    def testRoundTrip(self):
+        items = [(u'a', u'x;y:z\\w'), (u'b', u''), (u'c', u'\xe1')]
+        self.assertEqual(format_attributes(items), u'a:x\\;y\\:z\\\\w;b:;c:\xe1')
+        self.assertEqual(parse_attributes(format_attributes(items)), items)
+
+class CaptureTestCase(unittest.TestCase):
+    def testRedact(self):
+        record = request_record(MockRequest(method='GET', uri='http://example.com/api',
+            META={'QUERY_STRING': 'a=1&oauth_signature=abc%3D&oauth_signature_method=PLAINTEXT&client_secret=x',
+            'HTTP_AUTHORIZATION': 'OAuth realm="", oauth_signature="abc%3D", oauth_nonce="n"'}))
+        self.assertEqual(record['q'], 'a=1&oauth_signature=-&oauth_signature_method=PLAINTEXT&client_secret=-')
+        self.assertEqual(record['a'], 'OAuth realm="", oauth_signature="-", oauth_nonce="n"')
+        record = request_record(MockRequest(method='GET', uri='http://example.com/api',
+            META={'QUERY_STRING': '', 'HTTP_AUTHORIZATION': 'OAuth oauth_signature=cs%26ts, oauth_nonce=n'}))
+        self.assertEqual(record['a'], 'OAuth oauth_signature=-, oauth_nonce=n')
+        self.assertEqual(record['h'], 'example.com')
+        self.assertFalse('b' in record)
+
+class StatsTestCase(unittest.TestCase):
+    def testAdd(self):
+        stats = Stats()
+        stats.add('a', 1, 0.5)
+        stats.add('a', 2, 0.25)
+        stats.add('b', 1)
+        self.assertEqual(sorted(stats.items()), [('a', (3, 0.75)), ('b', (1,))])
+        self.assertEqual(stats.get('c', (0,)), (0,))
+
+class NegativeCacheTestCase(unittest.TestCase):
+    def testBounded(self):
+        cache = NegativeCache(2, 60)
+        for key in ('a', 'b', 'c'):
+            cache.add(key)
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+        self.assertTrue('c' in cache)
+        cache.discard('b')
+        self.assertFalse('b' in cache)
+        self.assertEqual(cache.get_stats(), {'entries': 1, 'added': 3, 'absorbed': 2})
+
+    def testExpiry(self):
+        cache = NegativeCache(2, -1)
+        cache.add('a')
+        self.assertFalse('a' in cache)
+
+class AuditLogTestCase(unittest.TestCase):
+    def testDropAndFlush(self):
+        written = []
+        log = AuditLog(written.extend, 2, 10, 0)
+        # Keep the writer thread from draining the queue
+        log.thread = True
+        token = Token(consumer_id=1, key='k' * 32)
+        for event in ('issue', 'authorize', 'exchange'):
+            log.record(event, token)
+        log.flush()
+        self.assertEqual([e[0] for e in written], ['issue', 'authorize'])
+        self.assertEqual(log.get_stats(), {'queued': 0, 'written': 2,
+            'failed': 0, 'blocked': 0, 'dropped': 1})
+
+class PaginatorTestCase(unittest.TestCase):
+    def testPageList(self):
+        paginator = Paginator(range(100), 10, base_url='/c/',
+            page_suffix='%d/', current=5)
+        markup = paginator.page_list.as_div()
+        self.assertEqual(markup.count('<a class="curpage">5</a>'), 1)
+        self.assertTrue('<div class="start"><a href="/c/">1</a><a href="/c/2/">2</a></div>' in markup)
+        self.assertTrue('<div class="middle"><a href="/c/3/">3</a>' in markup)
+        self.assertTrue('<div class="end"><a href="/c/8/">8</a>' in markup)
+        self.assertTrue('<a href="/c/10/">10</a></div></div>' in markup)
+        self.assertEqual(Paginator(range(5), 10, base_url='/c/').page_list.as_ul(), u'')
+
+    def testKeysetCursor(self):
+        paginator = KeysetPaginator(Consumer.objects.all(), 10, 'name',
+            base_url='/consumers/', page_suffix='%d/')
+        consumer = Consumer(id=42, name=u'a, b')
+        cursor = paginator.encode_cursor(consumer)
+        self.assertEqual(cursor, u'a42,a, b')
+        self.assertEqual(paginator.decode_cursor(cursor), (False, 42, u'a, b'))
+        cursor = paginator.encode_cursor(consumer, backwards=True)
+        self.assertEqual(paginator.decode_cursor(cursor), (True, 42, u'a, b'))
+        for cursor in (u'', u'x42,a', u'a,b', u'aX,b'):
+            self.assertRaises(InvalidPage, paginator.decode_cursor, cursor)
+
+    def testKeysetFloatCursor(self):
+        paginator = KeysetPaginator(Consumer.objects.all(), 10, '-score',
+            base_url='/consumers/', page_suffix='%d/')
+        score = 1234.5678901234567
+        cursor = paginator.encode_cursor(Consumer(id=42, score=score))
+        self.assertEqual(paginator.decode_cursor(cursor), (False, 42, score))
+
+    def testKeysetInvalidValue(self):
+        for order_field in ('-updated_date', '-score', '-active_tokens'):
+            paginator = KeysetPaginator(Consumer.objects.all(), 10, order_field,
+                base_url='/consumers/', page_suffix='%d/')
+            self.assertRaises(InvalidPage, paginator.decode_cursor, u'a1,garbage')
+
+    def testKeysetUrl(self):
+        paginator = KeysetPaginator(Consumer.objects.all(), 10, '-updated_date',
+            base_url='/consumers/', page_suffix='%d/', query_string='order=name')
+        self.assertEqual(paginator.url(1), '/consumers/?order=name')
+        self.assertEqual(paginator.url(3, u'a1,x y'),
+            '/consumers/3/?order=name&cursor=a1%2Cx%20y')
+
+class SearchTestCase(unittest.TestCase):
+    def testTokenize(self):
+        self.assertEqual(tokenize(u'Foo-Bar baz_1'), [u'foo', u'bar', u'baz_1'])
+        self.assertEqual(tokenize(u'\xc1rbol, \xe1rbol'), [u'\xe1rbol', u'\xe1rbol'])
+        self.assertEqual(tokenize(u'a' * 100), [u'a' * 64])
+
+    def testConsumerTerms(self):
+        consumer = Consumer(name=u'Photo Sync', uri=u'http://photosync.example.com',
+            description=u'Sync your photo library')
+        terms = consumer_terms(consumer)
+        self.assertEqual(terms[u'=Photo Sync'], 0)
+        self.assertEqual(terms[u'photo'], 4)
+        self.assertEqual(terms[u'sync'], 4)
+        self.assertEqual(terms[u'photosync'], 2)
+        self.assertEqual(terms[u'library'], 1)
+
+class NonceTestCase(unittest.TestCase):
+    """Runs outside a test transaction, so the threads, each one
+    with its own connection, see the consumer"""
+    def setUp(self):
+        self.user = User.objects.create_user('nonces', 'nonces@example.com', 'secret')
+        self.consumer = Consumer(user=self.user, name=u'Nonces', version=u'1.0',
+            consumer_type='D', developer_email=u'dev@example.com',
+            uri=u'http://example.com', description=u'Nonce replays')
+        self.consumer.save()
+        transaction.commit_unless_managed()
+
+    def tearDown(self):
+        Nonce.objects.filter(consumer=self.consumer).delete()
+        self.consumer.delete()
+        self.user.delete()
+        transaction.commit_unless_managed()
+
+    def validate_nonce(self, value):
+        request = OAuthRequest(MockRequest())
+        request.consumer = self.consumer
+        request._oauth = {'nonce': value}
+        request.validate_nonce()
+
+    def testReplay(self):
+        # Outside a managed transaction, no savepoint is involved
+        self.assertFalse(transaction.is_managed())
+        self.validate_nonce('once')
+        self.assertRaises(OAuthInvalidNonceError, self.validate_nonce, 'once')
+        # The connection is still usable after the failed INSERT
+        self.assertEqual(Nonce.objects.filter(consumer=self.consumer).count(), 1)
+        self.validate_nonce('twice')
+
+    def testConcurrentReplay(self):
+        # Every thread would get its own in-memory database
+        if settings.DATABASE_ENGINE == 'sqlite3' and \
+            settings.DATABASE_NAME in ('', ':memory:'):
+            return
+
+        accepted = []
+        def validate():
+            request = OAuthRequest(MockRequest())
+            request.consumer = self.consumer
+            request._oauth = {'nonce': 'replayed'}
+            try:
+                try:
+                    request.validate_nonce()
+                    accepted.append(True)
+                except OAuthInvalidNonceError:
+                    pass
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=validate) for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(accepted), 1)
+
+class SnapshotTestCase(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('snapshot', 'snapshot@example.com', 'secret')
+        self.consumer = Consumer(user=self.user, name=u'Snapshot', version=u'1.0',
+            consumer_type='D', developer_email=u'dev@example.com',
+            uri=u'http://example.com', description=u'Snapshot')
+        self.consumer.save()
+        self.path = tempfile.mktemp(prefix='oauthsp-snapshot-')
+        self.previous = snapshot.consumer_snapshot
+
+    def tearDown(self):
+        snapshot.consumer_snapshot = self.previous
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+    def testChangedConsumers(self):
+        snapshot.write_snapshot(self.path)
+        snapshot.consumer_snapshot = snapshot.ConsumerSnapshot(self.path, 0)
+        found = snapshot.get_consumer(self.consumer.key)
+        self.assertEqual((found.id, found.secret), (self.consumer.id, self.consumer.secret))
+
+        # Saved after the snapshot was built
+        self.consumer.secret = random_string(32)
+        self.consumer.save()
+        self.assertEqual(snapshot.get_consumer(self.consumer.key), None)
+
+        snapshot.write_snapshot(self.path)
+        self.assertNotEqual(snapshot.get_consumer(self.consumer.key), None)
+        key = self.consumer.key
+        self.consumer.delete()
+        self.assertEqual(snapshot.get_consumer(key), None)
+
+    def testLazyConsumer(self):
+        snapshot.write_snapshot(self.path)
+        snapshot.consumer_snapshot = snapshot.ConsumerSnapshot(self.path, 0)
+        request = OAuthRequest(MockRequest())
+        request._oauth = {'consumer_key': self.consumer.key}
+        self.assertQueryBudget(0, request.validate_consumer)
+        self.assertEqual(request.signing_consumer.secret, self.consumer.secret)
+        self.assertFalse(isinstance(request.signing_consumer, Consumer))
+        consumer = self.assertQueryBudget(1, getattr, request, 'consumer')
+        self.assertEqual(consumer.name, u'Snapshot')
+
+    def testCacheBackend(self):
+        snapshot.check_cache_backend('memcached://127.0.0.1:11211/')
+        snapshot.check_cache_backend('db://oauthsp_cache')
+        for backend in ('locmem://', 'dummy://'):
+            self.assertRaises(ImproperlyConfigured, snapshot.check_cache_backend, backend)
+
+class OAuthTestCase(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('owner', 'owner@example.com', 'secret')
+        self.consumer = Consumer(user=self.user, name=u'Budget', version=u'1.0',
+            consumer_type='D', developer_email=u'dev@example.com',
+            uri=u'http://example.com', description=u'Query budgets')
+        self.consumer.save()
+        # Keep the usage counts from being flushed mid test
+        usage_counter.last_flush = time.time()
+
+    def tearDown(self):
+        # Or they would be written to the real database at exit
+        usage_counter.discard()
+
+    def create_token(self, token_type):
+        token = Token(consumer=self.consumer, token_type=token_type)
+        if token_type != 'R':
+            token.user = self.user
+        token.save()
+        return token
+
+    def oauth_params(self, token=None):
+        params = {
+            'oauth_consumer_key': self.consumer.key,
+            'oauth_signature_method': 'PLAINTEXT',
+            'oauth_timestamp': str(int(time.time())),
+            'oauth_nonce': random_string(16),
+            'oauth_version': '1.0',
+            'oauth_signature': b64encode('%s&%s' % (self.consumer.secret,
+                token and token.secret or '')),
+        }
+        if token:
+            params['oauth_token'] = token.key
+        return params
+
+    def login(self):
+        self.client.login(username='owner', password='secret')
+
+class QueryBudgetTestCase(OAuthTestCase):
+    def testRequestToken(self):
+        response = self.assertQueryBudget(3, self.client.get,
+            reverse('request-token'), self.oauth_params())
+        self.assertEqual(response.status_code, 200)
+
+    def testHeaderNonce(self):
+        params = self.oauth_params()
+        params['oauth_nonce'] = u'\xe9t\xe9'.encode('utf-8')
+        header = 'OAuth realm="", ' + ', '.join(['%s="%s"' % (k, url_quote(v, ''))
+            for k, v in params.items()])
+        response = self.client.get(reverse('request-token'), HTTP_AUTHORIZATION=header)
+        self.assertEqual(response.status_code, 200)
+
+    def testAccessToken(self):
+        token = self.create_token('S')
+        response = self.assertQueryBudget(5, self.client.get,
+            reverse('access-token'), self.oauth_params(token))
+        self.assertEqual(response.status_code, 200)
+
+    def testValidateAccess(self):
+        token = self.create_token('A')
+        request = MockRequest(('GET', urlencode(self.oauth_params(token))))
+        self.assertQueryBudget(3, OAuthRequest(request).validate_access)
+        self.assertEqual(request.oauthsp_queries['validate_access'].count, 3)
+
+    def testAuthorize(self):
+        token = self.create_token('R')
+        self.login()
+        response = self.assertQueryBudget(5, self.client.get,
+            reverse('authorize-token'), {'oauth_token': token.key})
+        self.assertEqual(response.status_code, 200)
+
+    def testRevoke(self):
+        self.create_token('A')
+        self.login()
+        self.assertQueryBudget(3, self.client.get, reverse('revoke'))
+
+    def testRevokeToken(self):
+        token = self.create_token('A')
+        self.login()
+        response = self.assertQueryBudget(4, self.client.get,
+            reverse('revoke-token', args=[token.id]))
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(Token.objects.get(id=token.id).revoked)
+        self.assertFalse(Token.access.filter(id=token.id))
+
+    def testNewConsumer(self):
+        self.login()
+        self.assertQueryBudget(2, self.client.get, reverse('new-consumer'))
+
+    def testEditConsumer(self):
+        self.login()
+        self.assertQueryBudget(4, self.client.get,
+            reverse('edit-consumer', args=[self.consumer.id]))
+
+    def testConsumer(self):
+        response = self.assertQueryBudget(1, self.client.get,
+            reverse('consumer', args=[self.consumer.id]))
+        self.assertEqual(response.status_code, 200)
+
+    def testConsumers(self):
+        response = self.assertQueryBudget(1, self.client.get, reverse('consumers'))
+        self.assertEqual(response.status_code, 200)
+
+    def testUsageOrderCache(self):
+        def cached(order):
+            response = self.client.get(reverse('consumers'), {'order': order})
+            return response['X-OAuthSP-Cache']
+        for order in ('popular', 'name'):
+            self.assertEqual((cached(order), cached(order)), ('miss', 'hit'))
+        usage_counter.count(self.create_token('A'))
+        usage_counter.flush()
+        self.assertEqual((cached('popular'), cached('name')), ('miss', 'hit'))
+
+    def testSearchConsumers(self):
+        response = self.assertQueryBudget(3, self.client.get,
+            reverse('search-consumers'), {'q': 'budget'})
+        self.assertEqual(response.status_code, 200)
+
+    def testSearchResults(self):
+        ids = []
+        for name in (u'Budget photos', u'Budget photo sync'):
+            consumer = Consumer(user=self.user, name=name, version=u'1.0',
+                consumer_type='D', developer_email=u'dev@example.com',
+                uri=u'http://example.com', description=u'Photos')
+            consumer.save()
+            ids.append(consumer.id)
+        # Only matches "budget"
+        ids.append(self.consumer.id)
+        results = search_consumers(u'budget photos')
+        self.assertEqual(self.assertQueryBudget(1, len, results), 3)
+        self.assertEqual(self.assertQueryBudget(1, results.__getitem__, slice(1, 3)), ids[1:])
+        self.assertEqual(results[0], ids[0])
+        self.assertEqual(len(search_consumers(u'')), 0)
+
+        previous = oauthsp.search.MAX_RESULTS
+        oauthsp.search.MAX_RESULTS = 2
+        try:
+            results = search_consumers(u'budget')
+            self.assertEqual(len(results), 2)
+            self.assertEqual(len(results[0:10]), 2)
+        finally:
+            oauthsp.search.MAX_RESULTS = previous
+
+    def testImage(self):
+        response = self.assertQueryBudget(1, self.client.get,
+            reverse('consumer-image', args=['0' * 40, 'png']))
+        self.assertEqual(response.status_code, 404)
+
+    def testImageUrl(self):
+        image = StoredImage.acquire('image.png', StringIO('png data'))
+        self.consumer.small_image_id = image.stored_file_id
+        url = self.assertQueryBudget(1, self.consumer.get_small_image_url)
+        self.assertEqual(url, image.get_absolute_url())
+
+        StoredImage.release(image.stored_file_id)
+        self.assertFalse(StoredImage.objects.filter(id=image.id))
+        self.assertFalse(StoredFile.objects.filter(id=image.stored_file_id))
+
+    def testStats(self):
+        self.client.get(reverse('request-token'), self.oauth_params())
+        self.login()
+        self.assertEqual(self.client.get(reverse('stats')).status_code, 302)
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('stats'))
+        stats = simplejson.loads(response.content)
+        self.assertEqual(sorted(stats.keys()), ['audit', 'misses', 'queries', 'views'])
+        self.assertTrue(stats['queries']['request_token'][0] >= 1)
+
+    def testCleanup(self):
+        old = datetime.now() - timedelta(seconds=3 * 3600)
+        tokens = {}
+        for name, can_renew, duration in (('expired', False, 3600),
+            ('renewable', True, 2 * 3600), ('stale', True, 3600)):
+            token = self.create_token('A')
+            token.can_renew = can_renew
+            token.duration = duration
+            token.creation_date = old
+            token.save()
+            tokens[name] = token.id
+        call_command('oauthsp_cleanup')
+        self.assertEqual(list(Token.objects.values_list('id', flat=True)),
+            [tokens['renewable']])
+
+    def testRevokeTokens(self):
+        for token_type in ('R', 'A', 'A'):
+            self.create_token(token_type)
+        count = self.assertQueryBudget(2, revoke_tokens, consumer=self.consumer)
+        self.assertEqual(count, 3)
+        self.assertEqual(Token.objects.filter(revoked=False).count(), 0)
+        self.assertEqual(revoke_tokens(user=self.user), 0)
+
+class TestAttributes(Attributes):
+    """Token attributes model for TokenAttributesTestCase"""
+    color = models.CharField(max_length=16, default='')
+    size = models.IntegerField(default=0)
+
+    class Meta:
+        app_label = 'oauthsp'
+
+def png_data(size, color='red'):
+    buf = StringIO()
+    Image.new('RGB', size, color).save(buf, 'PNG')
+    return buf.getvalue()
+
+class ImageTestCase(OAuthTestCase):
+    def clean_image(self, data):
+        form = ConsumerForm()
+        form.cleaned_data = {'image': SimpleUploadedFile('image.png', data)}
+        return form.clean_image()
+
+    def testCleanImage(self):
+        fobj = self.clean_image(png_data((128, 128)))
+        self.assertEqual(fobj.tell(), 0)
+        for data in (png_data((64, 64)), png_data((256, 128)), 'not an image',
+            'x' * (1024 * 1024 + 1)):
+            self.assertRaises(forms.ValidationError, self.clean_image, data)
+
+    def testRenderThumbnails(self):
+        renditions = images.render_thumbnails(Image.open(StringIO(png_data((256, 256)))))
+        self.assertEqual(Image.open(renditions['image'][1]).size, (128, 128))
+        self.assertEqual(Image.open(renditions['small_image'][1]).size, (64, 64))
+
+    def write_image(self, color='red'):
+        fd, path = tempfile.mkstemp(prefix='oauthsp-test-')
+        os.write(fd, png_data((256, 256), color))
+        os.close(fd)
+        return path
+
+    def testProcessImage(self):
+        path = self.write_image()
+        images.process_image(self.consumer.id, path)
+        self.assertFalse(os.path.exists(path))
+        consumer = Consumer.objects.get(id=self.consumer.id)
+        self.assertTrue(consumer.image_id and consumer.small_image_id)
+        self.assertNotEqual(consumer.image_id, consumer.small_image_id)
+        self.assertEqual(consumer.webp_image_id, None)
+
+        # The old renditions are released when replaced
+        old = consumer.image_id
+        images.process_image(self.consumer.id, self.write_image('blue'))
+        self.assertFalse(StoredImage.objects.filter(stored_file=old))
+        self.assertEqual(StoredImage.objects.count(), 2)
+
+    def testFlush(self):
+        job_queue = images.ImageJobQueue(1, 10)
+        path = self.write_image()
+        job_queue.queue.put_nowait((self.consumer.id, path))
+        job_queue.flush()
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(Consumer.objects.get(id=self.consumer.id).image_id)
+
+class QuerySetPaginatorTestCase(OAuthTestCase):
+    def setUp(self):
+        super(QuerySetPaginatorTestCase, self).setUp()
+        for i in xrange(24):
+            User.objects.create_user('user%d' % i, 'user%d@example.com' % i, 'secret')
+        invalidate_cached_counts(User)
+
+    def paginator(self, count_strategy):
+        return QuerySetPaginator(User.objects.order_by('id'), 10,
+            count_strategy=count_strategy)
+
+    def testCachedCount(self):
+        self.assertEqual(self.paginator(COUNT_CACHED).count, 25)
+        User.objects.create_user('late', 'late@example.com', 'secret')
+        self.assertEqual(self.assertQueryBudget(0, getattr,
+            self.paginator(COUNT_CACHED), 'count'), 25)
+        invalidate_cached_counts(User)
+        self.assertEqual(self.paginator(COUNT_CACHED).count, 26)
+
+    def testEstimateFallback(self):
+        # Too few rows for the estimate, so the count is cached
+        self.assertEqual(self.paginator(COUNT_ESTIMATE).count, 25)
+        User.objects.create_user('late', 'late@example.com', 'secret')
+        self.assertEqual(self.paginator(COUNT_ESTIMATE).count, 25)
+        self.assertEqual(self.paginator(COUNT_EXACT).count, 26)
+
+    def testLookahead(self):
+        paginator = self.paginator(COUNT_LOOKAHEAD)
+        page = self.assertQueryBudget(1, paginator.page, 1)
+        self.assertEqual(len(page.object_list), 10)
+        self.assertTrue(page.has_next())
+        self.assertEqual(self.assertQueryBudget(0, getattr, paginator, 'count'), 11)
+        self.assertEqual(paginator.num_pages, 2)
+        # Past the pages known so far, but not past the rows
+        page = self.assertQueryBudget(1, paginator.page, 3)
+        self.assertEqual(len(page.object_list), 5)
+        self.assertFalse(page.has_next())
+        self.assertEqual(paginator.count, 25)
+        self.assertTrue(paginator.page(2).has_next())
+        self.assertEqual(paginator.num_pages, 3)
+        self.assertRaises(InvalidPage, paginator.page, 4)
+
+class TokenAttributesTestCase(OAuthTestCase):
+    def setUp(self):
+        super(TokenAttributesTestCase, self).setUp()
+        self.previous = (oauthsp.models.TOKEN_ATTRS_MODEL, oauthsp.models.TOKEN_ATTRS_INLINE)
+        TestAttributes.schema = AttributeSchema(TestAttributes)
+        oauthsp.models.TOKEN_ATTRS_MODEL = TestAttributes
+        oauthsp.models.TOKEN_ATTRS_INLINE = False
+
+    def tearDown(self):
+        super(TokenAttributesTestCase, self).tearDown()
+        oauthsp.models.TOKEN_ATTRS_MODEL, oauthsp.models.TOKEN_ATTRS_INLINE = self.previous
+
+    def request_token(self, budget):
+        params = self.oauth_params()
+        params['oauth_token_attributes'] = 'color:red;size:3'
+        response = self.assertQueryBudget(budget, self.client.get,
+            reverse('request-token'), params)
+        self.assertEqual(response.status_code, 200)
+        return Token.objects.get(key=QueryDict(response.content)['oauth_token'])
+
+    def testRequestToken(self):
+        token = self.request_token(4)
+        self.assertEqual(token.attributes, None)
+        attrs = TestAttributes.objects.get(token=token)
+        self.assertEqual((attrs.color, attrs.size), (u'red', 3))
+
+    def testRequestTokenInline(self):
+        oauthsp.models.TOKEN_ATTRS_INLINE = True
+        token = self.request_token(4)
+        self.assertEqual(token.attributes, u'color:red;size:3')
+        attrs = TestAttributes.objects.get(token=token)
+        self.assertEqual((attrs.color, attrs.size), (u'red', 3))
+
+    def testInlineWithoutAttributes(self):
+        oauthsp.models.TOKEN_ATTRS_INLINE = True
+        token = self.create_token('A')
+        self.assertEqual(token.attributes, u'')
+        token = Token.objects.get(id=token.id)
+        attrs = self.assertQueryBudget(0, getattr, token, 'attrs')
+        self.assertEqual(attrs.as_dict(), {'color': u'', 'size': 0})
+        attrs.save()
+        self.assertFalse(TestAttributes.objects.filter(token=token))
+
+    def testInlineCopyFromForm(self):
+        oauthsp.models.TOKEN_ATTRS_INLINE = True
+        token = self.create_token('A')
+        for color in (u'blue', u'black'):
+            form = Form()
+            form.cleaned_data = {'color': color, 'size': 5}
+            Token.objects.get(id=token.id).attrs.copy_from_form(form)
+            self.assertEqual(Token.objects.get(id=token.id).attributes,
+                u'color:%s;size:5' % color)
+            attrs = TestAttributes.objects.get(token=token)
+            self.assertEqual((attrs.color, attrs.size), (color, 5))
+
+    def testLegacyToken(self):
+        token = self.create_token('A')
+        TestAttributes(token=token, color=u'green').save()
+        oauthsp.models.TOKEN_ATTRS_INLINE = True
+        token = Token.objects.get(id=token.id)
+        self.assertEqual(token.attributes, None)
+        self.assertEqual(token.attrs.color, u'green')
+
+class BulkTestCase(OAuthTestCase):
+    def roundtrip(self, format, keep_ids):
+        token = self.create_token('A')
+        fobj = StringIO()
+        self.assertEqual(bulk.export_rows(Token, fobj, format), 1)
+        Token.objects.all().delete()
+        fobj.seek(0)
+        rows = list(bulk.read_rows(fobj, format))
+        if not keep_ids:
+            for row in rows:
+                del row['id']
+        self.assertEqual(bulk.import_rows(Token, rows), 1)
+        imported = Token.objects.get(key=token.key)
+        if keep_ids:
+            self.assertEqual(imported.id, token.id)
+        self.assertEqual(imported.last_used, None)
+        self.assertEqual(imported.creation_date, token.creation_date)
+        self.assertEqual(imported.expiration_date,
+            token.creation_date + timedelta(seconds=token.duration))
+
+    def testJsonLines(self):
+        self.roundtrip('jsonl', True)
+
+    def testJsonLinesWithoutIds(self):
+        self.roundtrip('jsonl', False)
+
+    def testCsv(self):
+        self.roundtrip('csv', True)
+
+    def testCsvWithoutIds(self):
+        self.roundtrip('csv', False)
+
+    def import_consumers(self):
+        fobj = StringIO()
+        bulk.export_rows(Consumer, fobj, 'jsonl')
+        Consumer.objects.all().delete()
+        self.assertFalse(name_taken(u'Budget'))
+        fobj.seek(0)
+        rows = list(bulk.read_rows(fobj, 'jsonl'))
+        for row in rows:
+            del row['id']
+        bulk.import_rows(Consumer, rows)
+        return Consumer.objects.get(key=self.consumer.key)
+
+    def testConsumerDates(self):
+        consumer = self.import_consumers()
+        self.assertEqual(consumer.updated_date, self.consumer.updated_date)
+        self.assertEqual(consumer.registration_date, self.consumer.registration_date)
+
+        row = {'user_id': self.user.id, 'name': u'Minimal', 'version': u'1.0',
+            'consumer_type': 'W', 'developer_email': u'dev@example.com',
+            'uri': u'http://example.com', 'description': u'Defaults'}
+        before = datetime.now()
+        self.assertEqual(bulk.import_rows(Consumer, [row]), 1)
+        consumer = Consumer.objects.get(name=u'Minimal')
+        self.assertTrue(consumer.updated_date >= before)
+        self.assertEqual(len(consumer.key), 32)
+        del row['user_id']
+        self.assertRaises(ValueError, bulk.import_rows, Consumer, [row])
+
+    def testMissesDiscarded(self):
+        consumer_misses.add(self.consumer.key)
+        self.import_consumers()
+        self.assertFalse(self.consumer.key in consumer_misses)
+
+    def testConsumersIndexed(self):
+        consumer = self.import_consumers()
+        self.assertTrue(name_taken(u'Budget'))
+        self.assertEqual(search_consumers(u'budget')[0:1], [consumer.id])
+
 
 def diffstring(s1, s2):
     if len(s1) != len(s2):
@@ -27,6 +27,9 @@ urlpatterns = patterns('oauthsp.views',
     url(r'^consumer/(?P<consumer_id>\d+)/edit/$', 'edit_consumer', name='edit-consumer'),
     url('^new-consumer/$', 'new_consumer', name='new-consumer'),
     url('^consumers/((?P<page>\d+)/)?$', 'consumers', name='consumers'),
+    url('^consumers/search/((?P<page>\d+)/)?$', 'search_consumers', name='search-consumers'),
+    url(r'^image/(?P<digest>[0-9a-f]{40})\.(?P<extension>\w+)$', 'image', name='consumer-image'),
+    url('^stats/$', 'stats', name='stats'),
     url('^revoke/$', 'revoke', name='revoke'),
     url('^revoke/(?P<token_id>\d+)/$', 'revoke', name='revoke-token'),
     url('^request_token$', 'request_token', name='request-token'),
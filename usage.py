@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import time
+import atexit
+import logging
+import threading
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from oauthsp.models import Consumer, Token
+from oauthsp.viewcache import invalidate_usage_orders
+
+# Successful validate_access calls are counted in memory and
+# written behind, once every OAUTH_USAGE_FLUSH_INTERVAL seconds,
+# with a few batched UPDATEs instead of a write per request.
+# The interval is checked when counting, so idle processes keep
+# their counts until the next call or until they exit.
+# Token.last_used is written behind the same way, and only when
+# the stored value is older than OAUTH_TOKEN_LAST_USED_INTERVAL.
+
+FLUSH_INTERVAL = getattr(settings, 'OAUTH_USAGE_FLUSH_INTERVAL', 60)
+LAST_USED_INTERVAL = timedelta(seconds=getattr(settings, 'OAUTH_TOKEN_LAST_USED_INTERVAL', 300))
+
+class UsageCounter(object):
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.consumers = {}
+        self.tokens = {}
+        self.last_used = {}
+        self.last_flush = time.time()
+
+    def count(self, token):
+        now = datetime.now()
+        self.lock.acquire()
+        try:
+            self.consumers[token.consumer_id] = self.consumers.get(token.consumer_id, 0) + 1
+            self.tokens[token.id] = self.tokens.get(token.id, 0) + 1
+            if token.last_used is None or now - token.last_used >= LAST_USED_INTERVAL:
+                self.last_used[token.id] = now
+            if time.time() - self.last_flush < self.interval:
+                return
+            pending = self._swap()
+        finally:
+            self.lock.release()
+
+        self.write(*pending)
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            pending = self._swap()
+        finally:
+            self.lock.release()
+
+        self.write(*pending)
+
+    def discard(self):
+        """Drops the counts not written yet (e.g. at the end of a test)"""
+        self.lock.acquire()
+        try:
+            self._swap()
+        finally:
+            self.lock.release()
+
+    def _swap(self):
+        pending = self.consumers, self.tokens, self.last_used
+        self.consumers, self.tokens, self.last_used = {}, {}, {}
+        self.last_flush = time.time()
+        return pending
+
+    def write(self, consumers, tokens, last_used):
+        if not consumers:
+            return
+
+        qn = connection.ops.quote_name
+        consumer_table = qn(Consumer._meta.db_table)
+        token_table = qn(Token._meta.db_table)
+        cursor = connection.cursor()
+        cursor.executemany('UPDATE %s SET %s = %s + %%s WHERE %s = %%s' % \
+            (token_table, qn('calls'), qn('calls'), qn('id')),
+            [(calls, pk) for pk, calls in tokens.items()])
+        if last_used:
+            cursor.executemany('UPDATE %s SET %s = %%s WHERE %s = %%s' % \
+                (token_table, qn('last_used'), qn('id')),
+                [(when, pk) for pk, when in last_used.items()])
+        cursor.executemany('UPDATE %s SET %s = %s + %%s WHERE %s = %%s' % \
+            (consumer_table, qn('score'), qn('score'), qn('id')),
+            [(calls, pk) for pk, calls in consumers.items()])
+        ids = consumers.keys()
+        cursor.execute('UPDATE %(consumer)s SET %(active_tokens)s =' \
+            ' (SELECT COUNT(*) FROM %(token)s WHERE %(token)s.%(consumer_id)s = %(consumer)s.%(id)s' \
+            ' AND %(token_type)s = %%s AND %(revoked)s = %%s AND %(expiration_date)s > %%s)' \
+            ' WHERE %(id)s IN (%(params)s)' % {
+                'consumer': consumer_table,
+                'token': token_table,
+                'active_tokens': qn('active_tokens'),
+                'consumer_id': qn('consumer_id'),
+                'id': qn('id'),
+                'token_type': qn('token_type'),
+                'expiration_date': qn('expiration_date'),
+                'revoked': qn('revoked'),
+                'params': ', '.join(['%s'] * len(ids)),
+            }, ['A', False, datetime.now()] + ids)
+        transaction.commit_unless_managed()
+        # The raw UPDATEs don't send post_save
+        invalidate_usage_orders()
+
+usage_counter = UsageCounter(FLUSH_INTERVAL)
+
+def flush_at_exit():
+    # The tables might not exist anymore, don't end with a traceback
+    try:
+        usage_counter.flush()
+    except Exception:
+        logging.exception('Error writing the usage counts at exit')
+
+atexit.register(flush_at_exit)
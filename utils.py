@@ -20,7 +20,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import os
+import re
+import time
 import urllib2
+import threading
+
+from django.core.cache import cache
+
+# memcached won't keep anything for longer than 30 days
+GENERATION_TIMEOUT = 30 * 86400
 
 def quote(s):
     return urllib2.quote(s.encode('utf8'), safe='~')
@@ -28,3 +37,108 @@ def quote(s):
 def unquote(s):
     return urllib2.unquote(s)
 
+UNRESERVED = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-._~')
+REQUOTE_RE = re.compile(r'%([0-9A-Fa-f]{2})|([^A-Za-z0-9\-._~])')
+
+def _requote(match):
+    if match.group(1):
+        c = chr(int(match.group(1), 16))
+        if c in UNRESERVED:
+            return c
+        return '%' + match.group(1).upper()
+    if match.group(2) == '+':
+        return '%20'
+    return '%%%02X' % ord(match.group(2))
+
+def requote(s):
+    """Takes a raw (bytes) query string component and returns it
+    encoded as quote() would encode it once decoded, without
+    decoding it."""
+    return REQUOTE_RE.sub(_requote, s)
+
+def split_query(qs):
+    """Returns the (key, value) pairs in a raw query string or
+    form body, with their encoding normalized by requote().
+    Like QueryDict, splits on '&' and ';' and keeps blank
+    values."""
+    pairs = []
+    for part in qs.replace(';', '&').split('&'):
+        if not part:
+            continue
+        k, sep, v = part.partition('=')
+        pairs.append((requote(k), requote(v)))
+    return pairs
+
+def get_generation(name):
+    """Returns the current generation stamp for name. Cache keys
+    including it become stale as soon as bump_generation(name)
+    is called."""
+    key = 'oauthsp.generation.%s' % name
+    generation = cache.get(key)
+    if generation is None:
+        generation = bump_generation(name)
+
+    return generation
+
+def bump_generation(name):
+    generation = '%.6f' % time.time()
+    cache.set('oauthsp.generation.%s' % name, generation, GENERATION_TIMEOUT)
+    return generation
+
+class RotatingFileWriter(object):
+    """Appends lines to path. Once the file grows past max_bytes
+    it's renamed to path.1 (path.1 to path.2 and so on) and the
+    oldest of the backups is removed. Callers must serialize
+    their writes."""
+    def __init__(self, path, max_bytes, backups):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+    def write(self, lines):
+        fobj = open(self.path, 'ab')
+        try:
+            fobj.write(''.join(lines))
+            size = fobj.tell()
+        finally:
+            fobj.close()
+
+        if self.max_bytes and size >= self.max_bytes:
+            self.rotate()
+
+    def rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            src = '%s.%d' % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (self.path, i + 1))
+        if self.backups:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.unlink(self.path)
+
+class Stats(object):
+    """Per process totals, keyed by name. Every total is a tuple
+    and add() sums the given values into it element-wise."""
+    def __init__(self):
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def add(self, name, *values):
+        self.lock.acquire()
+        try:
+            total = self.totals.get(name)
+            if total is not None:
+                values = tuple([a + b for a, b in zip(total, values)])
+            self.totals[name] = values
+        finally:
+            self.lock.release()
+
+    def get(self, name, default):
+        return self.totals.get(name, default)
+
+    def items(self):
+        self.lock.acquire()
+        try:
+            return self.totals.items()
+        finally:
+            self.lock.release()
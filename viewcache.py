@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+# Copyright (c) 2008 Alberto García Hierro <fiam@rm-fr.net>
+
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+from functools import wraps
+
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.translation import get_language
+
+from oauthsp.utils import Stats, get_generation, bump_generation
+
+# Rendered responses of the public consumer pages are cached for
+# anonymous users only, since logged in users get per-user sections
+# (their own consumers, private consumers they own). Set
+# OAUTH_VIEW_CACHE_TIMEOUT to 0 to disable it.
+
+VIEW_CACHE_TIMEOUT = getattr(settings, 'OAUTH_VIEW_CACHE_TIMEOUT', 300)
+
+stats = Stats()
+
+def record(name, hit):
+    if hit:
+        stats.add(name, 1, 0)
+    else:
+        stats.add(name, 0, 1)
+
+def get_stats():
+    """Returns a dict mapping every cached view name to a
+    (hits, misses, hit rate) tuple for this process."""
+    return dict([(name, (hits, misses, float(hits) / (hits + misses)))
+        for name, (hits, misses) in stats.items()])
+
+def invalidate_consumer(consumer_id):
+    """Drops the cached detail page for the consumer and every
+    cached directory page."""
+    bump_generation('view.consumer.%s' % consumer_id)
+    bump_generation('view.consumers')
+
+# Directory orders by the columns oauthsp.usage writes behind
+USAGE_ORDERS = ('popular', 'active')
+
+def invalidate_usage_orders():
+    """Drops the cached directory pages ordered by usage."""
+    bump_generation('view.consumers.usage')
+
+def consumer_key(request, consumer_id):
+    return 'oauthsp.view.consumer.%s.%s.%s' % (consumer_id,
+        get_generation('view.consumer.%s' % consumer_id), get_language())
+
+def consumers_key(request, page):
+    order = request.GET.get('order')
+    generation = get_generation('view.consumers')
+    if order in USAGE_ORDERS:
+        generation = '%s.%s' % (generation, get_generation('view.consumers.usage'))
+    return 'oauthsp.view.consumers.%s.%s' % (generation,
+        md5(repr((order, page, request.GET.get('cursor'),
+        get_language()))).hexdigest())
+
+def cache_anonymous(key_func):
+    """Caches the successful responses of the decorated view for
+    anonymous GET requests. key_func receives the view arguments
+    and returns the cache key."""
+    def decorator(view):
+        name = view.__name__
+        def wrapper(request, *args, **kwargs):
+            if not VIEW_CACHE_TIMEOUT or request.method != 'GET' or \
+                request.user.is_authenticated():
+                return view(request, *args, **kwargs)
+
+            key = key_func(request, *args, **kwargs)
+            cached = cache.get(key)
+            if cached is not None:
+                record(name, True)
+                content, content_type = cached
+                response = HttpResponse(content, content_type=content_type)
+                response['X-OAuthSP-Cache'] = 'hit'
+                return response
+
+            record(name, False)
+            response = view(request, *args, **kwargs)
+            if response.status_code == 200:
+                cache.set(key, (response.content, response['Content-Type']),
+                    VIEW_CACHE_TIMEOUT)
+            response['X-OAuthSP-Cache'] = 'miss'
+            return response
+
+        return wraps(view)(wrapper)
+    return decorator
@@ -20,12 +20,16 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+from urllib import urlencode
+
 from django.core.urlresolvers import reverse
-from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden
-from django.contrib.auth.decorators import login_required
+from django.http import HttpResponseRedirect, HttpResponse, HttpResponseForbidden, HttpResponsePermanentRedirect
+from django.utils.cache import patch_response_headers, patch_cache_control
+from django.contrib.auth.decorators import login_required, user_passes_test
 from django.shortcuts import get_object_or_404
 from django.utils.translation import gettext as _
 from django.utils.safestring import mark_safe
+from django.utils import simplejson
 from django.conf import settings
 
 # This allows the notes application to override
@@ -34,22 +38,34 @@ from django.conf import settings
 from django.views.generic import simple
 direct_to_template = simple.direct_to_template
 
-from storage.models import StoredFile
-
-from oauthsp.models import Consumer, Token, get_token_form
+from oauthsp.models import Consumer, Token, StoredImage, get_token_form
+from oauthsp import audit, negcache, querycount, viewcache
+from oauthsp.audit import audit_log
+from oauthsp.images import enqueue_image
+from oauthsp.viewcache import cache_anonymous, consumer_key, consumers_key
+from oauthsp.querycount import count_queries
+from oauthsp.profiling import sample_profile
 from oauthsp.request import OAuthRequest
 from oauthsp.exceptions import OAuthError, OAuthMissingParamError
-from oauthsp.paginator import QuerySetPaginator
+from oauthsp.paginator import Paginator, KeysetPaginator
+from oauthsp.search import search
 from forms import *
 
 CONSUMERS_PER_PAGE = 10
 CONSUMER_ORDER_MAPPINGS = {
     'newest': '-updated_date',
     'name': 'name',
+    'popular': '-score',
+    'active': '-active_tokens',
 }
 
 DEFAULT_CONSUMER_ORDER_FIELD = 'newest'
 
+# Image URLs are content addressed, so they never change
+IMAGE_CACHE_TIMEOUT = 365 * 86400
+
+@count_queries('new_consumer')
+@sample_profile('new_consumer')
 @login_required
 def new_consumer(request):
     if request.method == 'GET':
@@ -66,11 +82,12 @@ def new_consumer(request):
 
     consumer = form.save(commit=False)
     consumer.user = request.user
-    consumer.image = StoredFile.store_file('image.png', form.big_image)
-    consumer.small_image = StoredFile.store_file('image.png', form.small_image)
     consumer.save()
+    enqueue_image(consumer, form.cleaned_data['image'])
     return HttpResponseRedirect(consumer.get_absolute_url())
 
+@count_queries('edit_consumer')
+@sample_profile('edit_consumer')
 @login_required
 def edit_consumer(request, consumer_id):
     consumer = get_object_or_404(Consumer, id=consumer_id)
@@ -100,27 +117,34 @@ def edit_consumer(request, consumer_id):
     consumer.description = form.cleaned_data['description']
     consumer.private = form.cleaned_data['private']
     consumer.editable_attributes = form.cleaned_data['editable_attributes']
-    for_deletion = []
-    if hasattr(form, 'big_image'):
-        if consumer.image:
-            for_deletion = [consumer.image, consumer.small_image]
-
-        consumer.image = StoredFile.store_file('image.png', form.big_image)
-        consumer.small_image = StoredFile.store_file('image.png', form.small_image)
     consumer.save()
-    # Delete after changing the foreign keys
-    for obj in for_deletion:
-        obj.delete()
+    if form.cleaned_data['image']:
+        enqueue_image(consumer, form.cleaned_data['image'])
     return HttpResponseRedirect(consumer.get_absolute_url())
 
+@count_queries('consumer')
+@sample_profile('consumer')
+@cache_anonymous(consumer_key)
 def consumer(request, consumer_id):
     consumer = get_object_or_404(Consumer, id=consumer_id)
     if consumer.private and consumer.user != request.user:
         return HttpResponseForbidden(_('This consumer is private and you are not the owner'))
     return direct_to_template(request, 'oauthsp/consumer.html', locals())
 
+@count_queries('image')
+@sample_profile('image')
+def image(request, digest, extension):
+    image = get_object_or_404(StoredImage, digest=digest, extension=extension)
+    response = HttpResponsePermanentRedirect(image.stored_file.get_absolute_url())
+    patch_response_headers(response, IMAGE_CACHE_TIMEOUT)
+    patch_cache_control(response, public=True)
+    return response
+
+@count_queries('consumers')
+@sample_profile('consumers')
+@cache_anonymous(consumers_key)
 def consumers(request, page):
-    ordering = None
+    ordering = request.GET.get('order')
     base_url = request.path
     if page:
         base_url = base_url[:-(len(page) + 1)]
@@ -130,20 +154,44 @@ def consumers(request, page):
         ordering = DEFAULT_CONSUMER_ORDER_FIELD
         order_field = CONSUMER_ORDER_MAPPINGS[ordering]
 
-    cset = Consumer.objects.exclude(private=True).order_by(order_field)
-    page = QuerySetPaginator(cset, CONSUMERS_PER_PAGE, base_url=base_url, page_suffix='%d/').page_or_404(page or 1)
+    query_string = None
+    if ordering != DEFAULT_CONSUMER_ORDER_FIELD:
+        query_string = 'order=%s' % ordering
+
+    cset = Consumer.objects.exclude(private=True)
+    paginator = KeysetPaginator(cset, CONSUMERS_PER_PAGE, order_field,
+        base_url=base_url, page_suffix='%d/', query_string=query_string)
+    page = paginator.page_or_404(page or 1, request.GET.get('cursor'))
     if request.user.is_authenticated():
         user_consumers = Consumer.objects.filter(user=request.user)
     return direct_to_template(request, 'oauthsp/consumers.html', locals())
 
+@count_queries('search_consumers')
+@sample_profile('search_consumers')
+def search_consumers(request, page):
+    query = request.GET.get('q', '')
+    base_url = request.path
+    if page:
+        base_url = base_url[:-(len(page) + 1)]
+
+    paginator = Paginator(search(query), CONSUMERS_PER_PAGE, base_url=base_url,
+        page_suffix='%d/', query_string=urlencode({'q': query.encode('utf-8')}))
+    page = paginator.page_or_404(page or 1)
+    found = Consumer.objects.in_bulk(page.object_list)
+    consumers = [found[pk] for pk in page.object_list if pk in found]
+    return direct_to_template(request, 'oauthsp/search.html', locals())
+
+@count_queries('revoke')
+@sample_profile('revoke')
 @login_required
 def revoke(request, token_id=None):
     if token_id:
         token = get_object_or_404(Token, id=token_id)
-        if token.user != request.user:
+        if token.user_id != request.user.id:
             return HttpResponseForbidden(_('This token is not yours'))
 
-        token.delete()
+        token.revoke()
+        audit_log.record('revoke', token, request)
 
         return HttpResponseRedirect(reverse('revoke'))
 
@@ -151,12 +199,18 @@ def revoke(request, token_id=None):
     return direct_to_template(request, 'oauthsp/revoke.html', locals())
 
 # OAuth token manipulation
+@count_queries('request_token')
+@sample_profile('request_token')
 def request_token(request):
     try:
-        return HttpResponse(OAuthRequest(request).generate_request_token().to_string())
+        token = OAuthRequest(request).generate_request_token()
+        audit_log.record('issue', token, request)
+        return HttpResponse(token.to_string())
     except OAuthError, e:
         return e.get_response()
 
+@count_queries('authorize')
+@sample_profile('authorize')
 @login_required
 def authorize(request):
     if request.method == 'GET':
@@ -198,6 +252,7 @@ def authorize(request):
         token.attrs.copy_from_form(form)
 
     token.authorize(request.user)
+    audit_log.record('authorize', token, request)
     if form.cleaned_data['oauth_callback']:
         uri = form.cleaned_data['oauth_callback']
         if uri.find('?') < 0:
@@ -210,6 +265,8 @@ def authorize(request):
     authorized = True
     return direct_to_template(request, 'oauthsp/authorize.html', locals())
 
+@count_queries('access_token')
+@sample_profile('access_token')
 def access_token(request):
     oauth_request = OAuthRequest(request)
     try:
@@ -221,8 +278,22 @@ def access_token(request):
         if oauth_request.token.is_access():
             oauth_request.validate_session()
             token = oauth_request.token.renew()
+            audit_log.record('renew', token, request)
         else:
             token = oauth_request.token.exchange()
+            audit_log.record('exchange', token, request)
         return HttpResponse(token.to_string())
     except OAuthError, e:
         return e.get_response()
+
+@user_passes_test(lambda user: user.is_staff)
+def stats(request):
+    """Returns the query, view cache, negative cache and audit
+    log stats of the process serving the request, as JSON."""
+    data = {
+        'queries': querycount.get_stats(),
+        'views': viewcache.get_stats(),
+        'misses': negcache.get_stats(),
+        'audit': audit.get_stats(),
+    }
+    return HttpResponse(simplejson.dumps(data), mimetype='application/json')